@@ -13,10 +13,12 @@ from fastai.tabular.all import *
 from models import *
 from metrics import *
 from ml_dashboard import *
+from training import *
+from jobs import JobTable, ServerBusy, TrainingJob
+from cache import DatasetCache, MetricsCache
 import traceback
 import time
 from itertools import count
-from multiprocessing import Process
 
 # Add Generated folder to module path.
 PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -30,20 +32,10 @@ from ssedata import FunctionType
 _ONE_DAY_IN_SECONDS = 60 * 60 * 24
 _MINFLOAT = float("-inf")
 _TIMEOUT = 120  # Training time limit in seconds
-
-
-def train_and_update_metrics(
-    cwd: str, dsu: DataSetup, data: pd.DataFrame, return_dict: "dict[str, str]", model_name: str
-):
-    '''
-    Plugin main functionality 
-    '''
-    print(f"Training with <{model_name}>")
-    method = Models.getters(dsu=dsu, data=data)[model_name]
-    metrics: "dict[str, str]" = method() # Trains and gets metrics
-    update_metrics_csv(cwd, model_name, metrics)
-    print(f"\tSuccess, updated metrics")
-    return_dict["ret_val"] = metrics
+_MAX_JOBS_PER_WORKER = 20  # Models trained by a worker process before it's replaced
+_METRICS_CACHE_SIZE = 1000  # Metrics dicts kept for retrained-free refreshes, 0 disables caching
+_MAX_ACTIVE_JOBS = 16  # Training requests queued or running at once before answering "busy"
+_DATASET_CACHE_MB = 1024  # Memory for loaded training data kept between requests, 0 disables caching
 
 
 class ExtensionService(SSE.ConnectorServicer):
@@ -51,12 +43,39 @@ class ExtensionService(SSE.ConnectorServicer):
     A simple SSE-plugin created for the Column Operations example.
     """
 
-    def __init__(self, funcdef_file):
+    def __init__(
+        self,
+        funcdef_file,
+        max_parallel=None,
+        max_jobs_per_worker=None,
+        metrics_cache_size=_METRICS_CACHE_SIZE,
+        max_active_jobs=_MAX_ACTIVE_JOBS,
+        dataset_cache_mb=_DATASET_CACHE_MB,
+        cpus=None,
+    ):
         """
         Class initializer.
         :param funcdef_file: a function definition JSON file
+        :param max_parallel: number of models trained at the same time, defaults to the number of CPUs
+        :param max_jobs_per_worker: models trained by a worker process before it's replaced
+        :param metrics_cache_size: metrics of trained models kept in memory, 0 disables the cache
+        :param max_active_jobs: training requests queued or running at once, more are answered with "busy"
+        :param dataset_cache_mb: megabytes of loaded training data kept between requests, 0 disables the cache
+        :param cpus: cores shared by the models being trained, defaults to the number of CPUs
         """
         self._function_definitions = funcdef_file
+        self.pool = TrainingPool(
+            processes=max_parallel or default_max_parallel(),
+            timeout=_TIMEOUT,
+            max_jobs_per_worker=max_jobs_per_worker or _MAX_JOBS_PER_WORKER,
+            cpus=cpus,
+        )
+        self.jobs = JobTable(
+            self.pool,
+            MetricsCache(metrics_cache_size),
+            DatasetCache(dataset_cache_mb * 2**20),
+            max_active_jobs,
+        )
         self.scriptEval = ScriptEval()
         os.makedirs("logs", exist_ok=True)
         log_file = os.path.join(
@@ -79,42 +98,102 @@ class ExtensionService(SSE.ConnectorServicer):
         """
         return {
             0: "run_with_timeout",
+            1: "submit_training",
+            2: "get_training_status",
+            3: "get_training_results",
         }
 
-    @staticmethod
-    def run_with_timeout(request, context):
+    def run_with_timeout(self, request, context):
+        """
+        Trains the algorithms selected in the document and streams one row per algorithm
+        as soon as it has finished, containing its metrics or the error that stopped it.
+        Declared as a tensor function, as aggregations return a single row.
+        """
         ret_str: str = "success"
         try:
-            cwd = parse_request(request)
-            # "True" or "False"
-            run_training: str = pd.read_csv(cwd + "run_training.csv").columns.to_list()[0]
-            if run_training == "False":
-                print("No training requested")
-            else:
-                dsu = DataSetup(cwd)
-                data = dsu.load_data()
-                model_names = dsu.model_names
-                for model_name in model_names:
-                    return_dict: "dict[str, str]" = {"ret_val": None}
-                    p1 = Process(
-                        target=train_and_update_metrics,
-                        name="process_train_and_update_metrics",
-                        args=(cwd, dsu, data, return_dict, model_name)
-                    )
-                    p1.start()
-                    p1.join(timeout=_TIMEOUT)
-                    p1.terminate()
-                    ret_str = return_dict["ret_val"]
-                    if p1.exitcode is None:
-                        print(TimeoutError(f"Training took more than {_TIMEOUT} seconds"))
+            job = self.jobs.submit(parse_request(request))
+            for model_name, metrics, error in job.iter_results():
+                yield self._result_row(model_name, metrics, error)
+            if job.status == TrainingJob.FAILED:
+                ret_str = job.error
+            elif job.results:
+                return
+        except ServerBusy as e:
+            ret_str = self._busy_str(e)
         except Exception as e:
             ret_str = f"{type(e).__name__} was raised: {e}"
             print(traceback.format_exc())
 
-        print("Process finished")
-        yield SSE.BundledRows(
-            rows=[SSE.Row(duals=iter([SSE.Dual(strData=str(ret_str))]))]
-        )
+        yield self._string_row(ret_str)
+
+    def submit_training(self, request, context):
+        """
+        Starts training the algorithms selected in the document and returns the job id right away.
+        """
+        try:
+            ret_str = self.jobs.submit(parse_request(request)).id
+        except ServerBusy as e:
+            ret_str = self._busy_str(e)
+        except Exception as e:
+            ret_str = f"{type(e).__name__} was raised: {e}"
+            print(traceback.format_exc())
+        yield self._string_row(ret_str)
+
+    def get_training_status(self, request, context):
+        """
+        Returns the status and progress of a training job as a JSON string.
+        """
+        try:
+            ret_str = json.dumps(self.jobs.get(parse_request(request)).status_dict())
+        except Exception as e:
+            ret_str = f"{type(e).__name__} was raised: {e}"
+        yield self._string_row(ret_str)
+
+    def get_training_results(self, request, context):
+        """
+        Returns one row per algorithm a training job has finished so far, see _result_row.
+        Declared as a tensor function, as aggregations return a single row.
+        """
+        try:
+            job = self.jobs.get(parse_request(request))
+            if job.error is not None:
+                yield self._string_row(job.error)
+            for model_name, metrics, error in list(job.results):
+                yield self._result_row(model_name, metrics, error)
+        except Exception as e:
+            yield self._string_row(f"{type(e).__name__} was raised: {e}")
+
+    @staticmethod
+    def _busy_str(e):
+        """
+        :param e: ServerBusy raised by the job table
+        :return: JSON string telling Qlik to retry later
+        """
+        return json.dumps({"Status": "busy", "RetryAfter": str(e.retry_after)})
+
+    @staticmethod
+    def _string_row(s):
+        """
+        :param s: string to return to Qlik
+        :return: BundledRows with one string
+        """
+        return SSE.BundledRows(rows=[SSE.Row(duals=iter([SSE.Dual(strData=str(s))]))])
+
+    @staticmethod
+    def _result_row(model_name, metrics=None, error=None):
+        """
+        Builds the row returned to Qlik for a single trained algorithm.
+        :param model_name: algorithm name
+        :param metrics: metrics of the trained model, None if training failed
+        :param error: exception that stopped training, None on success
+        :return: BundledRows with one JSON string
+        """
+        result = {"Algorithm": model_name}
+        if error is None:
+            result.update(metrics)
+        else:
+            result["Error"] = f"{type(error).__name__}: {error}"
+        return ExtensionService._string_row(json.dumps(result))
 
     """
     Implementation of added functions.
@@ -260,12 +339,20 @@ class ExtensionService(SSE.ConnectorServicer):
                 "*** Running server in insecure mode on port: {} ***".format(port)
             )
 
+        # Worker processes import the ML libraries once here instead of on every request
+        self.pool.start()
+        logging.info(
+            "*** Started {} training worker processes ***".format(self.pool.processes)
+        )
+
         server.start()
         try:
             while True:
                 time.sleep(_ONE_DAY_IN_SECONDS)
         except KeyboardInterrupt:
             server.stop(0)
+            self.pool.stop()
+            self.jobs.datasets.clear()
 
 
 if __name__ == "__main__":
@@ -273,6 +360,18 @@ if __name__ == "__main__":
     parser.add_argument("--port", nargs="?", default="50052")
     parser.add_argument("--pem_dir", nargs="?")
     parser.add_argument("--definition_file", nargs="?", default="functions.json")
+    parser.add_argument("--max_parallel", nargs="?", type=int)
+    parser.add_argument("--max_jobs_per_worker", nargs="?", type=int)
+    parser.add_argument(
+        "--metrics_cache_size", nargs="?", type=int, default=_METRICS_CACHE_SIZE
+    )
+    parser.add_argument(
+        "--max_active_jobs", nargs="?", type=int, default=_MAX_ACTIVE_JOBS
+    )
+    parser.add_argument(
+        "--dataset_cache_mb", nargs="?", type=int, default=_DATASET_CACHE_MB
+    )
+    parser.add_argument("--cpus", nargs="?", type=int)
     args = parser.parse_args()
 
     # need to locate the file when script is called from outside it's location dir.
@@ -280,5 +379,13 @@ if __name__ == "__main__":
         os.path.dirname(os.path.abspath(__file__)), args.definition_file
     )
 
-    calc = ExtensionService(def_file)
+    calc = ExtensionService(
+        def_file,
+        max_parallel=args.max_parallel,
+        max_jobs_per_worker=args.max_jobs_per_worker,
+        metrics_cache_size=args.metrics_cache_size,
+        max_active_jobs=args.max_active_jobs,
+        dataset_cache_mb=args.dataset_cache_mb,
+        cpus=args.cpus,
+    )
     calc.Serve(args.port, args.pem_dir)
@@ -0,0 +1,226 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable
+from models import DataSetup
+from sharedframe import SharedFrame
+
+_HASH_CHUNK_SIZE = 1 << 20  # Bytes read at a time when hashing files
+# Configuration files written by the document, see DataSetup
+_REQUEST_FILES = (
+    "run_training.csv",
+    "target.csv",
+    "categorical.csv",
+    "continuous.csv",
+    "algorithm.csv",
+    "use_cache.csv",
+    "encoding.csv",
+    "search_budget.csv",
+    "race.csv",
+    "cv_folds.csv",
+    "incremental.csv",
+)
+
+# (path, size, mtime_ns) -> content hash, so that unchanged files are only hashed once
+_file_hashes: "dict[tuple[str, int, int], str]" = {}
+_file_hashes_lock = threading.Lock()
+
+
+def file_fingerprint(path: str) -> str:
+    """
+    Content hash of the file at path. The hash is remembered for as long as the file's size and
+    modification time stay the same.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _file_hashes_lock:
+        if key in _file_hashes:
+            return _file_hashes[key]
+    fingerprint = prefix_fingerprint(path, stat.st_size)
+    with _file_hashes_lock:
+        _file_hashes[key] = fingerprint
+    return fingerprint
+
+
+def prefix_fingerprint(path: str, size: int) -> str:
+    """
+    Content hash of the first size bytes of the file at path, which is the file_fingerprint the file
+    had when it was size bytes long
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while size > 0:
+            chunk = f.read(min(size, _HASH_CHUNK_SIZE))
+            if not chunk:
+                break
+            h.update(chunk)
+            size -= len(chunk)
+    return h.hexdigest()
+
+
+def request_fingerprint(cwd: str) -> str:
+    """
+    Cheap fingerprint of a training request: the document folder, the contents of its
+    configuration files and the size and modification time of export.csv
+    """
+    h = hashlib.blake2b(cwd.encode(), digest_size=16)
+    for name in _REQUEST_FILES:
+        try:
+            with open(cwd + name, "rb") as f:
+                h.update(f.read())
+        except FileNotFoundError:
+            h.update(b"missing")
+    try:
+        stat = os.stat(cwd + "export.csv")
+        h.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    except FileNotFoundError:
+        h.update(b"missing")
+    return h.hexdigest()
+
+
+def stable_repr(value: Any) -> str:
+    """
+    repr that doesn't change between processes, functions are represented by their qualified name
+    instead of their address
+    """
+    if isinstance(value, dict):
+        return (
+            "{"
+            + ", ".join(
+                f"{stable_repr(k)}: {stable_repr(v)}"
+                for k, v in sorted(value.items(), key=lambda kv: repr(kv[0]))
+            )
+            + "}"
+        )
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(stable_repr(v) for v in value) + "]"
+    if callable(value) and hasattr(value, "__qualname__"):
+        return f"{getattr(value, '__module__', '')}.{value.__qualname__}"
+    return repr(value)
+
+
+def dataset_fingerprint(dsu: DataSetup, max_rows: int) -> str:
+    """
+    Fingerprint of everything that determines the training data: the contents of export.csv,
+    the target, categorical and continuous feature lists and the number of rows sampled
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(file_fingerprint(dsu.cwd + "export.csv").encode())
+    h.update(
+        stable_repr(
+            [dsu.target_features, dsu.cat_features, dsu.cont_features, max_rows]
+        ).encode()
+    )
+    return h.hexdigest()
+
+
+def metrics_key(dataset_fp: str, model_name: str, settings: "dict[str, Any]") -> str:
+    """
+    Cache key of the metrics of model_name trained with settings (see Models.settings) on the dataset dataset_fp
+    """
+    return hashlib.blake2b(
+        stable_repr([dataset_fp, model_name, settings]).encode(), digest_size=16
+    ).hexdigest()
+
+
+class MetricsCache:
+    """
+    Thread-safe LRU cache of at most max_entries metrics dicts, keyed by metrics_key
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, dict[str, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> "dict[str, str]":
+        """
+        :return: a copy of the cached metrics, None on a miss
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return dict(self._entries[key])
+
+    def put(self, key: str, metrics: "dict[str, str]"):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = dict(metrics)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class _CachedDataset:
+    def __init__(self):
+        self.frame: SharedFrame = None
+        self.users = 0
+        self.loading = threading.Lock()
+
+
+class DatasetCache:
+    """
+    Process-wide LRU cache of prepared training data kept in shared memory, keyed by dataset_fingerprint
+    and the preprocessing.
+    Training workers attach to the cached blocks directly. Datasets in use are never evicted, the
+    others are evicted least recently used first while the cache holds more than max_bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, _CachedDataset]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def use(self, key: str, load: "Callable[[], SharedFrame]"):
+        """
+        Context manager giving the SharedFrame cached under key, created with load() on a miss.
+        Concurrent users of the same key share one load.
+        """
+        with self._lock:
+            entry = self._entries.setdefault(key, _CachedDataset())
+            entry.users += 1
+            self._entries.move_to_end(key)
+        try:
+            with entry.loading:
+                if entry.frame is None:
+                    entry.frame = load()
+                else:
+                    print("Training data found in cache")
+            yield entry.frame
+        finally:
+            with self._lock:
+                entry.users -= 1
+                if entry.frame is None and entry.users == 0:
+                    # Loading failed
+                    self._entries.pop(key, None)
+                self._evict()
+
+    def clear(self):
+        """
+        Releases all cached datasets that aren't in use
+        """
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry.users == 0 and entry.frame is not None:
+                    entry.frame.close()
+                    del self._entries[key]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(e.frame.nbytes for e in self._entries.values() if e.frame is not None)
+
+    def _evict(self):
+        # Called with self._lock held
+        size = self.nbytes
+        for key, entry in list(self._entries.items()):
+            if size <= self.max_bytes:
+                break
+            if entry.users == 0 and entry.frame is not None:
+                size -= entry.frame.nbytes
+                entry.frame.close()
+                del self._entries[key]
@@ -0,0 +1,203 @@
+import json
+import os
+import shutil
+import tempfile
+import pandas as pd
+import numpy as np
+
+_CACHE_VERSION = 1  # Bump when the on-disk layout changes
+
+
+class ExportCache:
+    """
+    Columnar sidecar cache of (some of the columns of) an export file, stored in a folder next to it
+    (export.csv -> export.csv.cache). Numeric columns are stored as raw arrays, text columns as int32 codes
+    plus a JSON list of categories. Columns are read through memory mapping, so sampling rows only touches the sampled rows.
+    The cache is valid for as long as the export's size and modification time are unchanged.
+    """
+
+    def __init__(self, export_fp: str):
+        self.export_fp = export_fp
+        self.dir = export_fp + ".cache"
+        self._meta: dict = None
+
+    def _stat(self) -> "dict[str, int]":
+        stat = os.stat(self.export_fp)
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def valid(self) -> bool:
+        try:
+            with open(os.path.join(self.dir, "meta.json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if meta.get("version") != _CACHE_VERSION or meta.get("export") != self._stat():
+            return False
+        self._meta = meta
+        return True
+
+    @property
+    def columns(self) -> "list[str]":
+        """
+        Cached columns, empty unless valid() has returned True
+        """
+        if self._meta is None:
+            return []
+        return [c["name"] for c in self._meta["columns"]]
+
+    @property
+    def rows(self) -> int:
+        return self._meta["rows"]
+
+    def take(self, rows: np.ndarray, columns: "list[str]") -> pd.DataFrame:
+        """
+        Reads the given row positions (sorted) of columns. Text columns are returned as after
+        pd.read_csv(dtype=str) and numeric columns as after pd.to_numeric
+        """
+        data: "dict[str, np.ndarray]" = {}
+        for i, column in enumerate(self._meta["columns"]):
+            if column["name"] not in columns:
+                continue
+            values = np.memmap(
+                os.path.join(self.dir, f"{i}.bin"),
+                dtype=column["dtype"],
+                mode="r",
+                shape=(self.rows,),
+            )[rows]
+            if column["categories"] is not None:
+                with open(os.path.join(self.dir, f"{i}.json"), encoding="utf-8") as f:
+                    # Trailing NaN for missing values (code -1)
+                    categories = np.array(json.load(f) + [np.nan], dtype=object)
+                values = categories.take(values)
+            elif column["integer"] and not np.isnan(values).any():
+                # Integer column with missing values elsewhere in the file
+                values = values.astype(np.int64)
+            data[column["name"]] = values
+        return pd.DataFrame({c: data[c] for c in columns}, index=pd.Index(rows))
+
+    def writer(self) -> "ExportCacheWriter":
+        return ExportCacheWriter(self)
+
+
+class ExportCacheWriter:
+    """
+    Builds an ExportCache from the chunks of pd.read_csv(chunksize=...) while they are being read
+    for other purposes. Columns must be read either as text (dtype=str) or with a fixed numeric dtype. Nothing is visible to readers until finish() has succeeded.
+    Failing to write the cache (e.g. a read-only or full disk) is printed and otherwise ignored.
+    """
+
+    def __init__(self, cache: ExportCache):
+        self.cache = cache
+        self.export_stat = cache._stat()
+        # Folder of this writer only, created with the first chunk
+        self.tmp_dir: str = None
+        self.rows = 0
+        self._columns: "list[str]" = None
+        # Per column, category -> code for text columns, None for numeric columns
+        self._categories: "list[dict[str, int]]" = None
+        self._dtypes: "list[np.dtype]" = None
+        self._files = None
+        self.failed = False
+
+    def add(self, chunk: pd.DataFrame):
+        if self.failed:
+            return
+        try:
+            self._add(chunk)
+        except OSError as e:
+            self._fail(e)
+
+    def finish(self):
+        if self.failed or self._columns is None:
+            return
+        try:
+            self._finish()
+        except OSError as e:
+            self._fail(e)
+
+    def abort(self):
+        if self._files is not None:
+            for f in self._files:
+                f.close()
+        if self.tmp_dir is not None:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _fail(self, e: OSError):
+        print(f"Could not write export cache <{self.cache.dir}>: {e}")
+        self.failed = True
+        self.abort()
+
+    def _add(self, chunk: pd.DataFrame):
+        if self._columns is None:
+            self.tmp_dir = tempfile.mkdtemp(
+                prefix=os.path.basename(self.cache.dir) + ".tmp",
+                dir=os.path.dirname(self.cache.dir) or None,
+            )
+            self._columns = list(chunk.columns)
+            self._categories = [
+                None if chunk[c].dtype.kind in "biuf" else {} for c in self._columns
+            ]
+            self._dtypes = [chunk[c].dtype for c in self._columns]
+            self._files = [
+                open(os.path.join(self.tmp_dir, f"{i}.bin"), "wb")
+                for i in range(len(self._columns))
+            ]
+        for i, name in enumerate(self._columns):
+            if self._categories[i] is None:
+                self._files[i].write(chunk[name].to_numpy().tobytes())
+                continue
+            codes, uniques = pd.factorize(chunk[name])
+            # Translate chunk codes to file-wide codes
+            categories = self._categories[i]
+            mapping = np.array(
+                [categories.setdefault(u, len(categories)) for u in uniques] + [-1],
+                dtype=np.int32,
+            )
+            self._files[i].write(mapping[codes].tobytes())
+        self.rows += len(chunk)
+
+    def _finish(self):
+        for f in self._files:
+            f.close()
+        columns = []
+        for i, name in enumerate(self._columns):
+            column = {"name": name, "categories": None, "integer": False}
+            values_fp = os.path.join(self.tmp_dir, f"{i}.bin")
+            if self._categories[i] is None:
+                column["dtype"] = self._dtypes[i].str
+                columns.append(column)
+                continue
+            codes = np.fromfile(values_fp, dtype=np.int32)
+            categories = list(self._categories[i])
+            try:
+                numbers = pd.to_numeric(pd.Series(categories, dtype=object))
+            except (ValueError, TypeError):
+                numbers = None
+            if numbers is not None and numbers.dtype.kind in "iuf":
+                column["integer"] = numbers.dtype.kind in "iu"
+                values = np.append(numbers.to_numpy(dtype=np.float64), np.nan)[codes]
+                if column["integer"] and (codes >= 0).all():
+                    values = np.append(numbers.to_numpy(dtype=np.int64), 0)[codes]
+            else:
+                column["categories"] = True
+                values = codes
+                with open(
+                    os.path.join(self.tmp_dir, f"{i}.json"), "w", encoding="utf-8"
+                ) as f:
+                    json.dump(categories, f)
+            column["dtype"] = values.dtype.str
+            values.tofile(values_fp)
+            columns.append(column)
+
+        with open(os.path.join(self.tmp_dir, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "version": _CACHE_VERSION,
+                    "export": self.export_stat,
+                    "rows": self.rows,
+                    "columns": columns,
+                },
+                f,
+            )
+        shutil.rmtree(self.cache.dir, ignore_errors=True)
+        os.replace(self.tmp_dir, self.cache.dir)
@@ -0,0 +1,158 @@
+import json
+import os
+import pickle
+import shutil
+from typing import Any
+from models import DataSetup, Models, Preprocessing
+from exportcache import ExportCache
+from cache import file_fingerprint, metrics_key, prefix_fingerprint, stable_repr
+
+_STATE_VERSION = 2  # Bump when the on-disk layout changes
+
+
+class IncrementalState:
+    """
+    Models of a document kept for training them further on the rows appended to its export since
+    (see DataSetup.incremental), in the folder incremental of the document. state.json records the
+    export the models were last trained on (its size, fingerprint and number of rows) and the settings of
+    each model. Each model is saved in <model name>.model and the Preprocessing of each kind of target in
+    prep_<y_is_cat>.pkl.
+    A run trains a model further if its settings are unchanged and the export has only been appended to,
+    its first bytes still having the recorded fingerprint. The run saves its models in a folder of its own,
+    which replaces the state only once the run has finished, so that a failed run leaves the last state intact.
+    """
+
+    def __init__(self, dsu: DataSetup, run_id: str):
+        self.dsu = dsu
+        self.dir = dsu.cwd + "incremental"
+        self.run_dir = f"{self.dir}.tmp{run_id}"
+        self.export_fp = dsu.cwd + "export.csv"
+        # The export the models of this run are trained on
+        self.export: "dict[str, Any]" = {
+            "size": os.stat(self.export_fp).st_size,
+            "fingerprint": file_fingerprint(self.export_fp),
+        }
+        self._state: "dict[str, Any]" = None
+        self.fingerprint: str = None
+        try:
+            with open(os.path.join(self.dir, "state.json")) as f:
+                state = json.load(f)
+            if state.get("version") == _STATE_VERSION:
+                self._state = state
+                self.fingerprint = file_fingerprint(os.path.join(self.dir, "state.json"))
+        except (OSError, ValueError):
+            pass
+
+    @property
+    def start_row(self) -> int:
+        """
+        Rows of the export the saved models have been trained on, the rows after them are new
+        """
+        return self._state["export"]["rows"]
+
+    def _key(self, model_name: str) -> str:
+        # Everything besides the data that the saved model of model_name depends on
+        features = stable_repr(
+            [self.dsu.target_features, self.dsu.cat_features, self.dsu.cont_features]
+        )
+        return metrics_key(features, model_name, Models.settings(model_name, self.dsu))
+
+    def _appended(self) -> bool:
+        # Whether rows have been appended to the export the saved models were trained on, and nothing else changed
+        if self._state is None:
+            return False
+        previous = self._state["export"]
+        return (
+            self.export["size"] > previous["size"]
+            and prefix_fingerprint(self.export_fp, previous["size"]) == previous["fingerprint"]
+        )
+
+    def resumable(self, model_names: "list[str]") -> "list[str]":
+        """
+        Those of model_names that can be trained further on the appended rows. Models predicting the same
+        kind of target share their Preprocessing, so they are either all trained further or all from zero.
+        """
+        if not self._appended():
+            return []
+        saved = self._state["models"]
+        resumable = []
+        for y_is_cat in {Models.y_is_cat[name] for name in model_names}:
+            names = [name for name in model_names if Models.y_is_cat[name] == y_is_cat]
+            if all(
+                saved.get(name) == self._key(name)
+                and os.path.exists(self.model_fp(self.dir, name))
+                for name in names
+            ) and os.path.exists(self._prep_fp(self.dir, y_is_cat)):
+                resumable += names
+        return resumable
+
+    def preprocessing(self, y_is_cat: bool) -> Preprocessing:
+        """
+        The Preprocessing the saved models predicting the y_is_cat kind of target were trained with
+        """
+        with open(self._prep_fp(self.dir, y_is_cat), "rb") as f:
+            return pickle.load(f)
+
+    def checkpoints(
+        self, model_names: "list[str]", resumed: "list[str]"
+    ) -> "dict[str, tuple[str, str]]":
+        """
+        (save_fp, resume_fp) of each of model_names, see Models.getters. The models of resumed are trained further
+        """
+        os.makedirs(self.run_dir, exist_ok=True)
+        return {
+            name: (
+                self.model_fp(self.run_dir, name),
+                self.model_fp(self.dir, name) if name in resumed else None,
+            )
+            for name in model_names
+        }
+
+    def save(self, trained: "dict[str, Preprocessing]"):
+        """
+        Makes the models of this run in trained, each with the Preprocessing it was trained with, the state.
+        Nothing is saved if no model was trained, so that the last state stays usable.
+        """
+        cache = ExportCache(self.export_fp)
+        if not trained:
+            reason = "no model was trained to the end"
+        elif os.stat(self.export_fp).st_size != self.export["size"]:
+            reason = "the export changed during training"
+        elif not cache.valid():
+            # Without the export cache, the number of rows trained on isn't known
+            reason = f"the export cache <{cache.dir}> couldn't be written"
+        else:
+            reason = None
+        if reason is not None:
+            print(f"Models not saved for incremental training, {reason}")
+            self.abort()
+            return
+        for name in os.listdir(self.run_dir):
+            if name[: -len(".model")] not in trained:
+                os.remove(os.path.join(self.run_dir, name))
+        for name, prep in trained.items():
+            with open(self._prep_fp(self.run_dir, prep.y_is_cat), "wb") as f:
+                pickle.dump(prep, f)
+        with open(os.path.join(self.run_dir, "state.json"), "w") as f:
+            json.dump(
+                {
+                    "version": _STATE_VERSION,
+                    "export": dict(self.export, rows=cache.rows),
+                    "models": {name: self._key(name) for name in trained},
+                },
+                f,
+            )
+        shutil.rmtree(self.dir, ignore_errors=True)
+        os.replace(self.run_dir, self.dir)
+        print(f"Saved {len(trained)} models for incremental training")
+
+    def abort(self):
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+
+    @staticmethod
+    def model_fp(dir: str, model_name: str) -> str:
+        return os.path.join(dir, f"{model_name}.model")
+
+    @staticmethod
+    def _prep_fp(dir: str, y_is_cat: bool) -> str:
+        return os.path.join(dir, f"prep_{y_is_cat}.pkl")
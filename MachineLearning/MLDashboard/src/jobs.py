@@ -0,0 +1,442 @@
+import logging
+import math
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from contextlib import ExitStack
+import pandas as pd
+from models import MAX_ROWS, DataSetup, Models, Preprocessing, cv_metrics, fit_rows
+from sharedframe import SharedFrame, SharedFrameSpec
+from ml_dashboard import update_metrics_csv
+from training import TrainingPool
+from incremental import IncrementalState
+from cache import (
+    DatasetCache,
+    MetricsCache,
+    dataset_fingerprint,
+    metrics_key,
+    request_fingerprint,
+)
+
+_MAX_FINISHED_JOBS = 100  # Finished jobs kept in the job table for fetching results
+_INITIAL_JOB_SECONDS = 30.0  # Assumed job duration before any job has finished
+_JOB_SECONDS_SMOOTHING = 0.2  # Weight of the latest job in the average job duration
+_RACE_RUNGS = 2  # Model race rungs before the survivors are trained on all rows
+_RACE_ETA = 3  # Growth of the rows between model race rungs
+_RACE_MIN_ROWS = 100  # Rungs on fewer rows are skipped
+_RACE_CONFIDENCE = 2.0  # Standard errors by which a candidate's loss must be worse to be dropped
+
+
+class ServerBusy(Exception):
+    """
+    Raised when the job queue is full. retry_after is an estimate of the seconds until a job finishes.
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Training queue is full, retry after {retry_after} s")
+        self.retry_after = retry_after
+
+
+class TrainingJob:
+    """
+    Training of the algorithms selected in one document, run on a background thread.
+    Results are appended as (model_name, metrics, error) in order of completion.
+    """
+
+    QUEUED = "queued"
+    LOADING = "loading"
+    RUNNING = "running"
+    FINISHED = "finished"
+    FAILED = "failed"
+
+    def __init__(self, cwd: str, fingerprint: str):
+        self.id = uuid.uuid4().hex
+        self.cwd = cwd
+        self.fingerprint = fingerprint
+        self.status = TrainingJob.QUEUED
+        self.error: str = None
+        self.model_names: "list[str]" = []
+        self.results: "list[tuple[str, dict[str, str], Exception]]" = []
+        self.created = time.time()
+        self.finished: float = None
+        self._changed = threading.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self.status in (TrainingJob.FINISHED, TrainingJob.FAILED)
+
+    def set_status(self, status: str, error: str = None):
+        with self._changed:
+            self.status = status
+            self.error = error
+            if self.done:
+                self.finished = time.time()
+            self._changed.notify_all()
+
+    def add_result(self, model_name: str, metrics: "dict[str, str]", error: Exception):
+        with self._changed:
+            self.results.append((model_name, metrics, error))
+            self._changed.notify_all()
+
+    def iter_results(self):
+        """
+        Yields results as they are added until the job is done
+        """
+        i = 0
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: i < len(self.results) or self.done)
+                new_results = self.results[i:]
+                done = self.done
+            yield from new_results
+            i += len(new_results)
+            if done and i == len(self.results):
+                return
+
+    def status_dict(self) -> "dict[str, str]":
+        return {
+            "JobId": self.id,
+            "Status": self.status,
+            "Done": str(len(self.results)),
+            "Total": str(len(self.model_names)),
+            "Error": self.error or "",
+        }
+
+
+class JobTable:
+    """
+    In-process table of training jobs. Submitting returns immediately, training runs on a
+    job thread that only waits on the TrainingPool, leaving gRPC threads free.
+    Algorithms whose metrics are in metrics_cache for identical data and hyperparameters are not retrained.
+    Identical requests, as fired by Qlik recalculation, are coalesced: while a job for the same document
+    and configuration is running, submitting again returns that job instead of starting another one.
+    At most max_active_jobs jobs load data or wait for the pool at once, further submissions raise ServerBusy.
+    Loaded training data is kept in datasets, so requests for the same data don't load it again.
+    Documents that ask for incremental training have their trained models saved, and train them further
+    on the rows appended to their export since, see IncrementalState.
+    """
+
+    def __init__(
+        self,
+        pool: TrainingPool,
+        metrics_cache: MetricsCache,
+        datasets: DatasetCache,
+        max_active_jobs: int,
+        max_finished: int = _MAX_FINISHED_JOBS,
+    ):
+        self.pool = pool
+        self.metrics_cache = metrics_cache
+        self.datasets = datasets
+        self.max_active_jobs = max(1, max_active_jobs)
+        self.max_finished = max_finished
+        self._avg_job_seconds = _INITIAL_JOB_SECONDS
+        self._jobs: "OrderedDict[str, TrainingJob]" = OrderedDict()
+        # Request fingerprint -> job that hasn't finished yet
+        self._in_flight: "dict[str, TrainingJob]" = {}
+        self._lock = threading.Lock()
+        self._metrics_csv_lock = threading.Lock()
+
+    def submit(self, cwd: str) -> TrainingJob:
+        fingerprint = request_fingerprint(cwd)
+        with self._lock:
+            running = self._in_flight.get(fingerprint)
+            if running is not None and not running.done:
+                logging.info(
+                    "Attaching to running training job {} for {}".format(running.id, cwd)
+                )
+                return running
+            if len(self._in_flight) >= self.max_active_jobs:
+                raise ServerBusy(self._retry_after())
+            job = TrainingJob(cwd, fingerprint)
+            self._in_flight[fingerprint] = job
+            self._jobs[job.id] = job
+            self._evict()
+        threading.Thread(
+            target=self._run, name=f"training_job_{job.id}", args=(job,), daemon=True
+        ).start()
+        return job
+
+    def get(self, job_id: str) -> TrainingJob:
+        with self._lock:
+            if job_id not in self._jobs:
+                raise KeyError(f"Unknown training job <{job_id}>")
+            return self._jobs[job_id]
+
+    def _retry_after(self) -> int:
+        # Called with self._lock held. Estimates when the oldest active job will finish
+        oldest = min(job.created for job in self._in_flight.values())
+        return max(1, math.ceil(self._avg_job_seconds - (time.time() - oldest)))
+
+    def _evict(self):
+        # Called with self._lock held. Drops the oldest finished jobs beyond max_finished
+        finished = [job_id for job_id, job in self._jobs.items() if job.done]
+        for job_id in finished[: max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+    def _run(self, job: TrainingJob):
+        try:
+            # "True" or "False"
+            run_training: str = pd.read_csv(job.cwd + "run_training.csv").columns.to_list()[0]
+            if run_training == "False":
+                print("No training requested")
+            else:
+                job.set_status(TrainingJob.LOADING)
+                dsu = DataSetup(job.cwd)
+                job.model_names = dsu.model_names
+                model_names: "list[str]" = []
+                for model_name in dsu.model_names:
+                    if model_name in Models.params:
+                        model_names.append(model_name)
+                    else:
+                        # Only fails that model, like any other model that can't be trained
+                        print(f"<{model_name}>: unknown algorithm")
+                        self._add_result(
+                            job, model_name, None, ValueError(f"Unknown algorithm <{model_name}>")
+                        )
+                dataset_fp = dataset_fingerprint(dsu, MAX_ROWS)
+                keys = {
+                    model_name: metrics_key(
+                        dataset_fp, model_name, Models.settings(model_name, dsu)
+                    )
+                    for model_name in model_names
+                }
+                to_train: "list[str]" = []
+                for model_name in model_names:
+                    metrics = None
+                    if dsu.use_cache:
+                        metrics = self.metrics_cache.get(keys[model_name])
+                    if metrics is None:
+                        to_train.append(model_name)
+                    else:
+                        print(f"<{model_name}>: metrics found in cache")
+                        self._add_result(job, model_name, metrics, None)
+                if to_train:
+                    with ExitStack() as stack:
+                        state: IncrementalState = None
+                        resumed: "dict[str, SharedFrameSpec]" = {}
+                        if dsu.incremental and dsu.cv_folds < 2:
+                            state = IncrementalState(dsu, job.id)
+                            stack.callback(state.abort)
+                            resumed = self._prepare_appended(
+                                dsu, dataset_fp, state, to_train, stack
+                            )
+                        specs = self._prepare(
+                            dsu,
+                            dataset_fp,
+                            [model_name for model_name in to_train if model_name not in resumed],
+                            stack,
+                        )
+                        job.set_status(TrainingJob.RUNNING)
+                        if dsu.race:
+                            specs = self._race(job, dsu, specs)
+                        specs.update(resumed)
+                        checkpoints = None
+                        if state is not None:
+                            checkpoints = state.checkpoints(list(specs), list(resumed))
+                        # Models trained to the end and the Preprocessing they were trained with
+                        trained: "dict[str, Preprocessing]" = {}
+                        for model_name, metrics, error in self._train(
+                            dsu, specs, checkpoints
+                        ):
+                            if error is not None:
+                                print(f"<{model_name}>: {error}")
+                            elif metrics.get("BudgetTruncated") == "True":
+                                # Another run may get further
+                                print(f"<{model_name}>: training was cut short by the timeout")
+                            else:
+                                self.metrics_cache.put(keys[model_name], metrics)
+                                trained[model_name] = specs[model_name].meta
+                            self._add_result(job, model_name, metrics, error)
+                        if state is not None:
+                            state.save(trained)
+            job.set_status(TrainingJob.FINISHED)
+        except Exception as e:
+            print(traceback.format_exc())
+            job.set_status(TrainingJob.FAILED, f"{type(e).__name__} was raised: {e}")
+        finally:
+            with self._lock:
+                if self._in_flight.get(job.fingerprint) is job:
+                    del self._in_flight[job.fingerprint]
+                self._avg_job_seconds += _JOB_SECONDS_SMOOTHING * (
+                    time.time() - job.created - self._avg_job_seconds
+                )
+        print("Process finished")
+
+    def _prepare(
+        self,
+        dsu: DataSetup,
+        dataset_fp: str,
+        model_names: "list[str]",
+        stack: ExitStack,
+    ) -> "dict[str, SharedFrameSpec]":
+        """
+        Prepares the data once for each preprocessing needed by model_names, or takes it from
+        self.datasets. The data stays cached at least until stack is closed.
+        :return: the spec of the prepared data of each model
+        """
+        data: "list[pd.DataFrame]" = []
+
+        def load(prep: Preprocessing) -> SharedFrame:
+            if not data:
+                data.append(dsu.load_data(max_rows=MAX_ROWS))
+            return SharedFrame(prep.fit_transform(data[0]), meta=prep)
+
+        shared: "dict[Preprocessing, SharedFrame]" = {}
+        specs: "dict[str, SharedFrameSpec]" = {}
+        for model_name, prep in Models.preprocessing(dsu, model_names).items():
+            if prep not in shared:
+                shared[prep] = stack.enter_context(
+                    self.datasets.use(f"{dataset_fp}:{prep.key}", lambda: load(prep))
+                )
+            specs[model_name] = shared[prep].spec
+        return specs
+
+    def _prepare_appended(
+        self,
+        dsu: DataSetup,
+        dataset_fp: str,
+        state: IncrementalState,
+        model_names: "list[str]",
+        stack: ExitStack,
+    ) -> "dict[str, SharedFrameSpec]":
+        """
+        Prepares the rows appended to the export since the models of state were trained, with the
+        Preprocessing they were trained with, for those of model_names that can be trained further
+        (see IncrementalState.resumable). If the appended rows can't be prepared that way (see
+        Preprocessing.transform), the models are left out, to be trained from zero.
+        The data stays cached at least until stack is closed.
+        :return: the spec of the prepared appended rows of each model to train further
+        """
+        resumable = state.resumable(model_names)
+        data: "list[pd.DataFrame]" = []
+
+        def load(prep: Preprocessing) -> SharedFrame:
+            if not data:
+                data.append(dsu.load_data(max_rows=MAX_ROWS, start_row=state.start_row))
+            if data[0].empty:
+                raise ValueError("No rows were appended")
+            return SharedFrame(prep.transform(data[0]), meta=prep)
+
+        specs: "dict[str, SharedFrameSpec]" = {}
+        for y_is_cat in {Models.y_is_cat[model_name] for model_name in resumable}:
+            prep = state.preprocessing(y_is_cat)
+            try:
+                shared = stack.enter_context(
+                    self.datasets.use(
+                        f"{dataset_fp}:{prep.key}:{state.fingerprint}", lambda: load(prep)
+                    )
+                )
+            except ValueError as e:
+                print(f"Training from zero, the appended rows can't be used: {e}")
+                continue
+            for model_name in resumable:
+                if Models.y_is_cat[model_name] == y_is_cat:
+                    print(f"<{model_name}>: training further on the appended rows")
+                    specs[model_name] = shared.spec
+        return specs
+
+    def _train(
+        self,
+        dsu: DataSetup,
+        specs: "dict[str, SharedFrameSpec]",
+        checkpoints: "dict[str, tuple[str, str]]" = None,
+    ):
+        """
+        Trains the models of specs in the pool, yielding (model_name, metrics, error) as they finish.
+        Models in checkpoints are saved and possibly trained further, see Models.getters.
+        If dsu.cv_folds is at least 2, the models are cross-validated: all their folds are trained in
+        parallel, and a model's metrics are the cv_metrics of its folds, or the error of its first failed fold.
+        """
+        if dsu.cv_folds < 2:
+            yield from self.pool.train(dsu=dsu, specs=specs, checkpoints=checkpoints)
+            return
+        folds: "dict[str, list[dict[str, str]]]" = {model_name: [] for model_name in specs}
+        for model_name, metrics, error in self.pool.train(
+            dsu=dsu, specs=specs, folds=dsu.cv_folds
+        ):
+            if folds[model_name] is None:
+                # Another fold has failed
+                continue
+            if error is not None:
+                folds[model_name] = None
+                yield model_name, None, error
+                continue
+            folds[model_name].append(metrics)
+            if len(folds[model_name]) == dsu.cv_folds:
+                yield model_name, cv_metrics(folds[model_name]), None
+
+    def _race(
+        self, job: TrainingJob, dsu: DataSetup, specs: "dict[str, SharedFrameSpec]"
+    ) -> "dict[str, SharedFrameSpec]":
+        """
+        Races the models of specs on growing subsamples of the training rows (1 / _RACE_ETA ** _RACE_RUNGS
+        of them first), scoring them on held-out training rows. After each rung, models whose loss is
+        clearly worse than the best one's of the same kind of target (their confidence intervals of
+        _RACE_CONFIDENCE standard errors don't overlap) are dropped and reported as such.
+        Models without a rival of the same kind of target skip the race.
+        :return: specs of the surviving models
+        """
+        survivors = dict(specs)
+        for rung in range(_RACE_RUNGS, 0, -1):
+            # Only models with a rival of the same kind of target can be dropped
+            kinds = [Models.y_is_cat[model_name] for model_name in survivors]
+            racing = {
+                model_name: spec
+                for model_name, spec in survivors.items()
+                if kinds.count(Models.y_is_cat[model_name]) > 1
+            }
+            if not racing:
+                break
+            n_fit = fit_rows(min(len(spec.meta.train_rows) for spec in racing.values()))
+            rows = n_fit // _RACE_ETA**rung
+            if rows < _RACE_MIN_ROWS:
+                continue
+            print(f"Racing {len(racing)} models on {rows} rows")
+            losses: "dict[str, tuple[float, float]]" = {}
+            for model_name, metrics, error in self.pool.train(
+                dsu=dsu, specs=racing, race_rows=rows
+            ):
+                if error is not None:
+                    print(f"<{model_name}>: {error}")
+                    del survivors[model_name]
+                    self._add_result(job, model_name, None, error)
+                else:
+                    losses[model_name] = (float(metrics["Loss"]), float(metrics["LossError"]))
+
+            for model_name, (loss, loss_error) in losses.items():
+                y_is_cat = Models.y_is_cat[model_name]
+                # The best model is the one with the lowest upper bound
+                best_upper, best_loss = min(
+                    (l + _RACE_CONFIDENCE * e, l)
+                    for name, (l, e) in losses.items()
+                    if Models.y_is_cat[name] == y_is_cat
+                )
+                if loss - _RACE_CONFIDENCE * loss_error > best_upper:
+                    print(f"<{model_name}>: dropped from the race with loss {loss:.4g}")
+                    del survivors[model_name]
+                    self._add_result(
+                        job,
+                        model_name,
+                        None,
+                        RuntimeError(
+                            f"Dropped from the model race on {rows} rows, loss {loss:.4g} "
+                            f"(lower bound {loss - _RACE_CONFIDENCE * loss_error:.4g}) was clearly worse "
+                            f"than the best model's loss {best_loss:.4g} (upper bound {best_upper:.4g})"
+                        ),
+                    )
+        return survivors
+
+    def _add_result(
+        self,
+        job: TrainingJob,
+        model_name: str,
+        metrics: "dict[str, str]",
+        error: Exception,
+    ):
+        if metrics is not None:
+            # Jobs of the same document may finish models at the same time
+            with self._metrics_csv_lock:
+                update_metrics_csv(job.cwd, model_name, metrics)
+        job.add_result(model_name, metrics, error)
@@ -21,6 +21,14 @@ class MetricsParser:
             **ClassificationMetrics(pred, targ).__get_all__()
         )
 
+    def metric_names() -> "list[str]":
+        return list(
+            dict(
+                RegressionMetrics(None, None).__get_empty__(),
+                **ClassificationMetrics(None, None).__get_empty__()
+            )
+        )
+
 
 class Metrics:
     def __init__(self, pred: Tensor, targ: Tensor):
@@ -1,13 +1,41 @@
+import os
+import pickle
+import time
 import pandas as pd
 
 import numpy as np
+import scipy.sparse as sp
+from copy import copy
+from joblib import effective_n_jobs
 from fastai.tabular.all import *
-from xgboost import XGBClassifier, XGBRegressor
-from sklearn.metrics import mean_absolute_error
+from xgboost import XGBClassifier, XGBModel, XGBRegressor
+from xgboost.callback import TrainingCallback
+from sklearn.metrics import accuracy_score, mean_absolute_error
 from sklearn.preprocessing import StandardScaler, LabelEncoder
 from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
 from sklearn.naive_bayes import GaussianNB
 from metrics import MetricsParser
+from exportcache import ExportCache
+from search import successive_halving
+
+MAX_ROWS = 5000  # Rows sampled from export.csv for training
+CHUNK_ROWS = 100000  # Rows of export.csv read at a time
+MISSING_VALUES = ["-"]  # Values in export.csv that mean a missing value
+# Categorical feature encodings a document can choose in encoding.csv, see Models.encodings
+ENCODINGS = ("default", "native", "target")
+TARGET_ENCODING_FOLDS = 5  # Folds of the training rows for out-of-fold target encoding
+TARGET_ENCODING_SMOOTHING = 10.0  # Rows' worth of weight given to the overall target mean
+# Share of the training rows held out for scoring hyperparameter search trials and model race rungs
+VALIDATION_PERCENTAGE = 0.2
+XGB_MAX_ROUNDS = 1000  # Boosting rounds XGBoost trains at most, early stopping usually ends training sooner
+# Rounds without improvement on the validation rows after which XGBoost stops, see fit_within
+XGB_EARLY_STOPPING_ROUNDS = 20
+INCREMENTAL_TREES = 20  # Trees a forest trained further adds, grown on the appended rows
+FINE_TUNE_EPOCHS = 3  # Epochs a FastAI learner trained further is fine-tuned for on the appended rows
+# Trees a forest grows at least at a time when training against a deadline, rounded up to a multiple of its n_jobs
+TREE_INCREMENT = 10
+# Share of the time left before the deadline the hyperparameter search may use, the rest is for the final fit
+SEARCH_DEADLINE_SHARE = 0.5
 
 
 class DataSetup:
@@ -23,6 +51,26 @@ class DataSetup:
         self.cont_features = cont_features
         self.model_names = model_names
         self.model_name = model_names[0]  # Only train one model at a time
+        # Optional "True" or "False", "False" retrains even if metrics for identical data are cached
+        self.use_cache = read_flag(cwd + "use_cache.csv", default=True)
+        # Optional scheduling class, "interactive" or "batch", and relative share of the training workers
+        self.priority = read_setting(cwd + "priority.csv", default="interactive")
+        self.weight = float(read_setting(cwd + "weight.csv", default=1))
+        # Optional seconds spent searching for hyperparameters (see Models.search), 0 trains with Models.params
+        self.search_budget = float(read_setting(cwd + "search_budget.csv", default=0))
+        # Optional "True" or "False", "True" races the algorithms on subsamples first, see JobTable._race
+        self.race = read_flag(cwd + "race.csv", default=False)
+        # Optional number of cross-validation folds (see Preprocessing.fold), below 2 uses the single test split
+        self.cv_folds = int(read_setting(cwd + "cv_folds.csv", default=0))
+        # Optional "True" or "False", "True" trains the models further on rows appended to the export
+        # since they were last trained instead of from zero, see IncrementalState
+        self.incremental = read_flag(cwd + "incremental.csv", default=False)
+        # Optional categorical feature encoding, one of ENCODINGS
+        self.encoding = read_setting(cwd + "encoding.csv", default="default")
+        if self.encoding not in ENCODINGS:
+            raise Exception(
+                f"Error: Unknown encoding <{self.encoding}>, expected one of {ENCODINGS}"
+            )
         self.features = (cat_features, cont_features, target_features)
         # If feature lists overlap, raise error
         for i_1, i_2 in [(0, 1), (0, 2), (1, 2)]:
@@ -35,14 +83,105 @@ class DataSetup:
         self.y_std: float = None
         self.y_mean: float = None
 
-    def load_data(self, max_rows=5000) -> "tuple[pd.DataFrame, pd.DataFrame]":
+    def load_data(
+        self, max_rows=MAX_ROWS, chunk_rows=CHUNK_ROWS, start_row=0
+    ) -> "tuple[pd.DataFrame, pd.DataFrame]":
         """
-        Loads and returns all rows (or as determined by max_rows, default 50000). Doesn't store any data.
+        Loads and returns all rows (or a random sample of max_rows rows, default MAX_ROWS). Doesn't store any data.
+        The first start_row rows are skipped, e.g. to only load the rows appended since they were trained on.
+        Only the target, categorical and continuous columns are read. Continuous columns are returned as
+        float32 (MISSING_VALUES as NaN) and categorical columns as pandas categoricals, of numbers if they
+        only contain numbers.
+        export.csv is streamed chunk_rows rows at a time and sampled with a fixed seed, so at most
+        max_rows + chunk_rows rows are held in memory however large the export is. While streaming,
+        a columnar ExportCache is written next to the export, and later loads sample from it instead.
         """
-        exportCSVFull = pd.read_csv(self.cwd + "export.csv")
+        export_fp = self.cwd + "export.csv"
+        header = list(pd.read_csv(export_fp, nrows=0).columns)
+        self._check_features(header)
+        features = set(self.cat_features + self.cont_features + self.target_features)
+        columns = [c for c in header if c in features]
+
+        # Every row gets a random key and the rows with the smallest keys are kept,
+        # which is a uniform sample without replacement
+        rng = np.random.default_rng(42)
+        cache = ExportCache(export_fp)
+        cached = cache.valid()
+        if cached and features <= set(cache.columns):
+            # Same keys as when streaming, so the sample doesn't depend on the cache
+            rows = np.arange(min(start_row, cache.rows), cache.rows)
+            if len(rows) > max_rows:
+                rows = rows[np.sort(np.argpartition(rng.random(len(rows)), max_rows)[:max_rows])]
+            try:
+                data = cache.take(rows, columns)
+            except (OSError, ValueError) as e:
+                # E.g. replaced by another writer while being read
+                print(f"Could not read export cache <{cache.dir}>, reading the export instead: {e}")
+                cached = False
+                rng = np.random.default_rng(42)
+            else:
+                return self._compact(data)
+
+        # Columns already in the cache stay in the rebuilt one
+        usecols = features | set(cache.columns if cached else [])
+        writer = cache.writer()
+        sample: pd.DataFrame = None
+        keys: np.ndarray = None
+        row = 0  # Position of the chunk in the export
+        try:
+            # Other columns are read as text, as their inferred type could differ between chunks
+            for chunk in pd.read_csv(
+                export_fp,
+                usecols=[c for c in header if c in usecols],
+                dtype={c: (np.float32 if c in self.cont_features else str) for c in usecols},
+                na_values={c: MISSING_VALUES for c in self.cont_features},
+                chunksize=chunk_rows,
+            ):
+                writer.add(chunk)
+                chunk, row = chunk.iloc[max(0, start_row - row) :][columns], row + len(chunk)
+                if sample is None:
+                    sample, keys = chunk, rng.random(len(chunk))
+                else:
+                    sample = pd.concat([sample, chunk])
+                    keys = np.concatenate([keys, rng.random(len(chunk))])
+                if len(sample) > max_rows:
+                    keep = np.argpartition(keys, max_rows)[:max_rows]
+                    keep.sort()  # Keep rows in file order
+                    sample, keys = sample.iloc[keep], keys[keep]
+            writer.finish()
+        finally:
+            writer.abort()  # Only leftovers of an unfinished cache are removed
+
+        if sample is None:
+            # Header only
+            sample = pd.DataFrame({c: pd.Series(dtype=str) for c in columns})
+
+        return self._compact(sample)
+
+    def _compact(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Converts continuous columns to float32 and categorical columns to categoricals
+        """
+        data: "dict[str, pd.Series]" = {}
+        for c in df.columns:
+            col = df[c]
+            if c in self.cont_features:
+                if col.dtype != np.float32:
+                    col = pd.to_numeric(col.replace(MISSING_VALUES, np.nan))
+                    col = col.astype(np.float32)
+            elif c in self.cat_features:
+                # Numbers as numeric categories whether they were read as text or from the export cache,
+                # so that categories (and their codes) are sorted the same way
+                col = infer_dtypes(col.to_frame())[c].astype("category")
+            else:
+                col = infer_dtypes(col.to_frame())[c]
+            data[c] = col
+        return pd.DataFrame(data, index=df.index)
+
+    def _check_features(self, columns: "list[str]"):
         illegal_features = list(
             filter(
-                lambda f: f not in exportCSVFull.columns,
+                lambda f: f not in columns,
                 self.cat_features + self.cont_features + self.target_features,
             )
         )
@@ -53,25 +192,347 @@ class DataSetup:
                 + ", ".join(illegal_features)
             )
 
-        if exportCSVFull.shape[0] > max_rows:
-            exportCSVFull = exportCSVFull.sample(n=max_rows, random_state=42)
 
-        return exportCSVFull
+def infer_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts text columns that only contain numbers to numeric columns, as pd.read_csv would
+    """
+
+    def infer(col: pd.Series) -> pd.Series:
+        try:
+            return pd.to_numeric(col)
+        except (ValueError, TypeError):
+            return col
+
+    return df.apply(infer)
+
+
+def read_setting(fp: str, default: Any) -> str:
+    """
+    Reads an optional single value setting file, returning default if the file doesn't exist
+    """
+    if not os.path.exists(fp):
+        return default
+    return pd.read_csv(fp).columns.to_list()[0]
 
 
-def split_data(data: pd.DataFrame, test_data_percentage=0.15):
+def read_flag(fp: str, default: bool) -> bool:
     """
-    Splits data in two parts randomly by test_data_percentage (default 0.15)
+    Reads an optional "True" or "False" flag file, returning default if the file doesn't exist
     """
-    rows = data.shape[0]
-    training_data, test_data = tuple(
-        pd.DataFrame(arr)
-        for arr in np.split(  # Halves array
-            data.sample(n=rows, random_state=42),
-            [int(rows * (1 - test_data_percentage))],
+    return str(read_setting(fp, default)) != "False"
+
+
+class Preprocessing:
+    """
+    Preprocessing shared by all models of a request that predict the same kind of target.
+    fit_transform fills missing values and encodes the data (prep_df), splits the rows randomly into
+    training rows and test rows (test_data_percentage, default 0.15) and fits the feature scaling on
+    the training rows. The prepared data keeps the row order of its input, the split is kept as row positions.
+    The fitted object is sent to every worker with the prepared data, which models only read:
+    their matrices are built from it with a single copy.
+    transform prepares rows appended to the export later the same way, for training models further.
+    """
+
+    def __init__(self, dsu: DataSetup, y_is_cat: bool, test_data_percentage=0.15):
+        self.cat_features = list(dsu.cat_features)
+        self.cont_features = list(dsu.cont_features)
+        self.target_feature = dsu.target_features[0]
+        self.y_is_cat = y_is_cat
+        self.test_data_percentage = test_data_percentage
+        # Positions of the training and test rows in the prepared data, in shuffled order
+        self.train_rows: np.ndarray = None
+        self.test_rows: np.ndarray = None
+        # Features in the order of export.csv
+        self.feature_columns: "list[str]" = []
+        # Number of categories of each categorical feature
+        self.n_categories: "dict[str, int]" = {}
+        # one_hot -> scaler fitted on the training rows of x_columns(one_hot), None if there are no such columns
+        self.scalers: "dict[bool, StandardScaler]" = {}
+        # Fill values of the continuous columns and categories of the others, see prep_params
+        self.medians: "dict[str, float]" = {}
+        self.categories: "dict[str, pd.Index]" = {}
+
+    @property
+    def key(self) -> str:
+        """
+        Identifies the prepared data among those of the same dataset
+        """
+        return f"y_is_cat={self.y_is_cat},test={self.test_data_percentage}"
+
+    def fit_transform(self, data: pd.DataFrame) -> pd.DataFrame:
+        data = self._features(data)
+        self.medians, self.categories = prep_params(data, cont=self._cont())
+        for col in self.cat_features:
+            # A code for missing values even if there are none, transform gives it to unseen categories
+            if "" not in self.categories[col]:
+                self.categories[col] = self.categories[col].append(pd.Index([""]))
+        data = prep_df(
+            df=data, cont=self._cont(), medians=self.medians, categories=self.categories
         )
+        self.feature_columns = [c for c in data.columns if c != self.target_feature]
+        self.n_categories = {col: len(self.categories[col]) for col in self.cat_features}
+
+        self._split(data.shape[0])
+        for one_hot in (False, True):
+            columns = self.x_columns(one_hot)
+            self.scalers[one_hot] = (
+                StandardScaler().fit(self._matrix(data, columns, self.train_rows))
+                if columns
+                else None
+            )
+        return data
+
+    def transform(self, data: pd.DataFrame) -> pd.DataFrame:
+        """
+        Prepares more rows of the export like fit_transform, with the fitted fill values, categories and
+        scaling, so that models trained on the fitted data can be trained further on them. Only the split
+        into training and test rows is drawn anew. Categories of the features that the fitted data doesn't
+        have are coded as missing values.
+        Raises ValueError if the target has classes the fitted data doesn't have or, for a categorical target,
+        if its training rows don't have every class
+        """
+        data = prep_df(
+            df=self._features(data),
+            cont=self._cont(),
+            medians=self.medians,
+            categories=self.categories,
+            unseen_as_missing=self.cat_features,
+        )
+        self._split(data.shape[0])
+        if self.y_is_cat:
+            classes = np.unique(data[self.target_feature].to_numpy()[self.train_rows])
+            if len(classes) < len(self.categories[self.target_feature]):
+                raise ValueError(
+                    f"Training rows only have {len(classes)} of the "
+                    f"{len(self.categories[self.target_feature])} classes of <{self.target_feature}>"
+                )
+        return data
+
+    def _features(self, data: pd.DataFrame) -> pd.DataFrame:
+        features = set(self.cat_features + self.cont_features + [self.target_feature])
+        return data[[c for c in data.columns if c in features]]
+
+    def _cont(self) -> "list[str]":
+        if self.y_is_cat:
+            return self.cont_features
+        return self.cont_features + [self.target_feature]
+
+    def _split(self, rows: int):
+        # Same order as data.sample(n=rows, random_state=42)
+        order = np.random.RandomState(42).permutation(rows)
+        n_train = int(rows * (1 - self.test_data_percentage))
+        self.train_rows, self.test_rows = order[:n_train], order[n_train:]
+
+    def x_columns(self, one_hot: bool) -> "list[str]":
+        """
+        Scaled feature columns of the prepared data, without the categorical columns if one_hot
+        """
+        return [
+            c
+            for c in self.feature_columns
+            if not (one_hot and c in self.cat_features)
+        ]
+
+    def fold(self, fold: int, folds: int) -> "Preprocessing":
+        """
+        Copy of the fitted preprocessing for cross-validation fold fold of folds: its test rows are
+        that fold's part of all rows, in shuffled order, and its training rows are the other parts.
+        Only the row positions differ, the prepared data and the fitted scaling are shared by all folds.
+        """
+        parts = np.array_split(np.concatenate([self.train_rows, self.test_rows]), folds)
+        prep = copy(self)
+        prep.train_rows = np.concatenate(parts[:fold] + parts[fold + 1 :])
+        prep.test_rows = parts[fold]
+        return prep
+
+    def split(self, data: pd.DataFrame) -> "tuple[pd.DataFrame, pd.DataFrame]":
+        """
+        Training and test rows of the prepared data
+        """
+        return data.take(self.train_rows), data.take(self.test_rows)
+
+    def xy(
+        self, data: pd.DataFrame, encoding: str = "codes"
+    ) -> "tuple[Any, Any, np.ndarray, np.ndarray]":
+        """
+        Scaled features and target of the training and test rows of the prepared data.
+        Categorical features are encoded by encoding:
+        "codes": scaled category codes
+        "one_hot": one-hot columns after the other features, in CSR matrices, see one_hot_csr
+        "target": out-of-fold target encoded columns after the other features, see target_encode
+        "native": pandas categoricals in DataFrames, for models with native categorical support
+        """
+        one_hot = encoding != "codes"
+        columns = self.x_columns(one_hot)
+        scaler = self.scalers[one_hot]
+        y = data[self.target_feature].to_numpy()
+        y_train, y_test = y[self.train_rows], y[self.test_rows]
+        if not one_hot:
+            return (
+                self._matrix(data, columns, self.train_rows, scaler),
+                self._matrix(data, columns, self.test_rows, scaler),
+                y_train,
+                y_test,
+            )
+
+        sizes = [self.n_categories[col] for col in self.cat_features]
+        codes_train = self._matrix(data, self.cat_features, self.train_rows, dtype=np.int32)
+        codes_test = self._matrix(data, self.cat_features, self.test_rows, dtype=np.int32)
+        x = []
+        for rows, codes in ((self.train_rows, codes_train), (self.test_rows, codes_test)):
+            if encoding == "one_hot":
+                values = np.empty((len(rows), len(columns) + len(sizes)), dtype=np.float32)
+                self._matrix(data, columns, rows, scaler, out=values[:, : len(columns)])
+                x.append(one_hot_csr(values, codes, sizes))
+            elif encoding == "target":
+                width = len(sizes) * target_encoding_width(y_train, self.y_is_cat)
+                matrix = np.empty((len(rows), len(columns) + width))
+                self._matrix(data, columns, rows, scaler, out=matrix[:, : len(columns)])
+                target_encode(
+                    codes_train,
+                    y_train,
+                    codes,
+                    sizes,
+                    self.y_is_cat,
+                    out=matrix[:, len(columns) :],
+                    oof=rows is self.train_rows,
+                )
+                x.append(matrix)
+            else:
+                x.append(
+                    self._native(self._matrix(data, columns, rows, scaler), codes, columns)
+                )
+        return x[0], x[1], y_train, y_test
+
+    @staticmethod
+    def _matrix(
+        data: pd.DataFrame,
+        columns: "list[str]",
+        rows: np.ndarray,
+        scaler: StandardScaler = None,
+        dtype=np.float64,
+        out: np.ndarray = None,
+    ) -> np.ndarray:
+        """
+        Matrix of the given rows of columns, scaled by scaler. The matrix (or out, if given) is
+        filled column by column, so at most one column is copied besides it.
+        """
+        if out is None:
+            out = np.empty((len(rows), len(columns)), dtype=dtype)
+        for j, c in enumerate(columns):
+            column = data[c].to_numpy()[rows]
+            if scaler is not None:
+                column = (column - scaler.mean_[j]) / scaler.scale_[j]
+            out[:, j] = column
+        return out
+
+    def _native(
+        self, scaled: np.ndarray, codes: np.ndarray, scaled_columns: "list[str]"
+    ) -> pd.DataFrame:
+        # Features in export.csv order, categorical ones as categoricals of their codes
+        columns = dict(zip(scaled_columns, scaled.T))
+        for j, col in enumerate(self.cat_features):
+            columns[col] = pd.Categorical.from_codes(
+                codes[:, j], categories=range(self.n_categories[col])
+            )
+        return pd.DataFrame({c: columns[c] for c in self.feature_columns}, copy=False)
+
+
+def one_hot_csr(values: np.ndarray, codes: np.ndarray, sizes: "list[int]") -> sp.csr_matrix:
+    """
+    CSR matrix of dense features followed by the one-hot encoding of each column of codes, column j
+    having sizes[j] categories. values has a column for each dense feature, holding its values, and
+    a column for each column of codes. It becomes the data of the matrix without being copied.
+    Every row stores its dense values (zeros included) and a 1 per categorical column, so memory
+    grows with the number of categorical columns instead of the number of categories.
+    """
+    rows, n_cat = codes.shape
+    width = values.shape[1]
+    n_dense = width - n_cat
+    n_columns = n_dense + int(sum(sizes))
+    # scipy would copy 64-bit indices to 32-bit ones if they fit
+    index_dtype = np.int32 if max(n_columns, rows * width) < 2**31 else np.int64
+    offsets = n_dense + np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(index_dtype)
+    values[:, n_dense:] = 1
+    indices = np.empty((rows, width), dtype=index_dtype)
+    indices[:, :n_dense] = np.arange(n_dense)
+    indices[:, n_dense:] = codes
+    indices[:, n_dense:] += offsets[:n_cat]
+    indptr = np.arange(0, rows * width + 1, width, dtype=index_dtype)
+    return sp.csr_matrix(
+        (values.reshape(-1), indices.reshape(-1), indptr), shape=(rows, n_columns)
     )
-    return training_data, test_data
+
+
+def target_encoding_width(y_train: np.ndarray, y_is_cat: bool) -> int:
+    """
+    Number of columns target_encode encodes each categorical column into
+    """
+    if not y_is_cat:
+        return 1
+    n_classes = int(y_train.max()) + 1 if len(y_train) else 1
+    return 1 if n_classes == 2 else n_classes
+
+
+def _target_columns(y_train: np.ndarray, y_is_cat: bool) -> np.ndarray:
+    # The continuous target, or an indicator column per class of a categorical target (the second class only if there are two)
+    if not y_is_cat:
+        return y_train.astype(np.float64).reshape(-1, 1)
+    width = target_encoding_width(y_train, y_is_cat)
+    classes = np.arange(width) if width > 1 else np.array([1])
+    return (y_train.reshape(-1, 1) == classes).astype(np.float64)
+
+
+def target_encode(
+    codes_train: np.ndarray,
+    y_train: np.ndarray,
+    codes: np.ndarray,
+    sizes: "list[int]",
+    y_is_cat: bool,
+    out: np.ndarray = None,
+    oof=False,
+    folds=TARGET_ENCODING_FOLDS,
+    smoothing=TARGET_ENCODING_SMOOTHING,
+) -> np.ndarray:
+    """
+    Replaces each categorical column of codes by the smoothed mean of the target per category, over the
+    training rows codes_train: the mean of a continuous target, or the share of each class of a categorical
+    target (of the second class only if there are two).
+    If oof, codes are the training rows themselves, and each is encoded with means over the other folds
+    of the training rows (rows are already shuffled), so that a row's own target doesn't leak into its features.
+    :param out: matrix to fill, of target_encoding_width columns per categorical column
+    """
+    targets = _target_columns(y_train, y_is_cat)
+    width = targets.shape[1]
+    if out is None:
+        out = np.empty((len(codes), len(sizes) * width))
+    prior = targets.mean(axis=0) if len(targets) else np.zeros(width)
+    fold = np.arange(len(codes_train)) % folds
+
+    for j, size in enumerate(sizes):
+        fit_codes = codes_train[:, j]
+        encoded = out[:, j * width : (j + 1) * width]
+
+        def means(fit: np.ndarray) -> np.ndarray:
+            fit_codes_j = fit_codes[fit]
+            counts = np.bincount(fit_codes_j, minlength=size)
+            sums = np.stack(
+                [
+                    np.bincount(fit_codes_j, weights=targets[fit, k], minlength=size)
+                    for k in range(width)
+                ],
+                axis=1,
+            )
+            return (sums + smoothing * prior) / (counts[:, None] + smoothing)
+
+        if oof:
+            for f in range(folds):
+                in_fold = fold == f
+                encoded[in_fold] = means(~in_fold)[codes[in_fold, j]]
+        else:
+            encoded[:] = means(np.ones(len(fit_codes), dtype=bool))[codes[:, j]]
+    return out
 
 
 def dict_values_to_str(d: dict):
@@ -99,138 +560,364 @@ class Models:
     Metrics getter functions
     """
 
-    def getters(dsu: DataSetup, data: pd.DataFrame):
-        return {
-            "Random Forest Classification": lambda: Models.sklearner(
-                dsu=dsu,
-                y_is_cat=True,
-                model=RandomForestClassifier(n_estimators=100, random_state=42),
-                data=data,
-            ),
-            "Random Forest Regression": lambda: Models.sklearner(
-                dsu=dsu,
-                y_is_cat=False,
-                model=RandomForestRegressor(n_estimators=100, random_state=42),
-                data=data,
-            ),
-            "XGBoost Classification": lambda: Models.sklearner(
-                dsu=dsu,
-                y_is_cat=True,
-                model=XGBClassifier(random_state=42),
-                do_one_hot=True,
+    # Hyperparameters each algorithm is trained with, also part of the metrics cache key
+    params: "dict[str, dict[str, Any]]" = {
+        "Random Forest Classification": dict(n_estimators=100, random_state=42),
+        "Random Forest Regression": dict(n_estimators=100, random_state=42),
+        "XGBoost Classification": dict(
+            tree_method="hist",
+            n_estimators=XGB_MAX_ROUNDS,
+            early_stopping_rounds=XGB_EARLY_STOPPING_ROUNDS,
+            random_state=42,
+        ),
+        "XGBoost Regression": dict(
+            tree_method="hist",
+            eval_metric="mae",
+            n_estimators=XGB_MAX_ROUNDS,
+            early_stopping_rounds=XGB_EARLY_STOPPING_ROUNDS,
+            random_state=42,
+        ),
+        "Gaussian Naive Bayes Classification": dict(),
+        "FastAI Tabular Classification": dict(),
+        "FastAI Tabular Regression": dict(),
+    }
+
+    # Whether each algorithm predicts a categorical target
+    y_is_cat: "dict[str, bool]" = {
+        "Random Forest Classification": True,
+        "Random Forest Regression": False,
+        "XGBoost Classification": True,
+        "XGBoost Regression": False,
+        "Gaussian Naive Bayes Classification": True,
+        "FastAI Tabular Classification": True,
+        "FastAI Tabular Regression": False,
+    }
+    # Categorical feature encoding each algorithm uses (see Preprocessing.xy) by the document's
+    # encoding setting, "default" for settings that aren't listed
+    encodings: "dict[str, dict[str, str]]" = {
+        "Random Forest Classification": {"default": "codes", "target": "target"},
+        "Random Forest Regression": {"default": "codes", "target": "target"},
+        "XGBoost Classification": {"default": "one_hot", "native": "native"},
+        "XGBoost Regression": {"default": "codes", "native": "native"},
+        "Gaussian Naive Bayes Classification": {"default": "codes"},
+    }
+
+    # Hyperparameter values tried by the search, for the algorithms that are searched.
+    # XGBoost's number of rounds is left to early stopping
+    search_spaces: "dict[str, dict[str, list[Any]]]" = {
+        "Random Forest Classification": dict(
+            n_estimators=[50, 100, 200],
+            max_depth=[3, 5, 10, 20, 30, 50, None],
+            min_samples_leaf=[1, 2, 5],
+            max_features=["sqrt", None],
+        ),
+        "Random Forest Regression": dict(
+            n_estimators=[50, 100, 200],
+            max_depth=[3, 5, 10, 20, 30, 50, None],
+            min_samples_leaf=[1, 2, 5],
+            max_features=["sqrt", None],
+        ),
+        "XGBoost Classification": dict(
+            max_depth=[3, 5, 6, 10],
+            learning_rate=[0.03, 0.1, 0.3],
+            subsample=[0.8, 1.0],
+            min_child_weight=[1, 5],
+        ),
+        "XGBoost Regression": dict(
+            max_depth=[3, 5, 6, 10],
+            learning_rate=[0.03, 0.1, 0.3],
+            subsample=[0.8, 1.0],
+            min_child_weight=[1, 5],
+        ),
+        "Gaussian Naive Bayes Classification": dict(
+            var_smoothing=[1e-11, 1e-10, 1e-9, 1e-8, 1e-7, 1e-6, 1e-5]
+        ),
+    }
+
+    # Constructor argument setting the number of threads of the algorithms that take one.
+    # FastAI's threads are set through torch.set_num_threads
+    thread_params: "dict[str, str]" = {
+        "Random Forest Classification": "n_jobs",
+        "Random Forest Regression": "n_jobs",
+        "XGBoost Classification": "n_jobs",
+        "XGBoost Regression": "n_jobs",
+    }
+
+    def encoding(model_name: str, setting: str) -> str:
+        """
+        Categorical feature encoding of model_name when the document's encoding setting is setting
+        """
+        encodings = Models.encodings.get(model_name, {"default": "codes"})
+        return encodings.get(setting, encodings["default"])
+
+    def model_params(model_name: str, setting: str) -> "dict[str, Any]":
+        """
+        Hyperparameters of model_name when the document's encoding setting is setting
+        """
+        params = dict(Models.params.get(model_name, {}))
+        if Models.encoding(model_name, setting) == "native":
+            params.update(tree_method="hist", enable_categorical=True)
+        return params
+
+    def settings(model_name: str, dsu: DataSetup) -> "dict[str, Any]":
+        """
+        Everything besides the data that determines the metrics of model_name, part of the metrics cache key
+        """
+        settings = {
+            "params": Models.model_params(model_name, dsu.encoding),
+            "encoding": Models.encoding(model_name, dsu.encoding),
+        }
+        if dsu.search_budget > 0 and model_name in Models.search_spaces:
+            settings["search_budget"] = dsu.search_budget
+        if dsu.cv_folds > 1:
+            settings["cv_folds"] = dsu.cv_folds
+        if dsu.incremental:
+            settings["incremental"] = True
+        return settings
+
+    def preprocessing(
+        dsu: DataSetup, model_names: "list[str]"
+    ) -> "dict[str, Preprocessing]":
+        """
+        Preprocessing of each of model_names. Models with the same kind of target share one
+        """
+        shared: "dict[bool, Preprocessing]" = {}
+        for y_is_cat in {Models.y_is_cat[name] for name in model_names}:
+            shared[y_is_cat] = Preprocessing(dsu, y_is_cat=y_is_cat)
+        return {name: shared[Models.y_is_cat[name]] for name in model_names}
+
+    def getters(
+        dsu: DataSetup,
+        data: pd.DataFrame,
+        prep: Preprocessing,
+        threads: int = 1,
+        race_rows: int = None,
+        deadline: float = None,
+        checkpoint: "tuple[str, str]" = None,
+    ):
+        """
+        data is the output of the fitted prep, see Models.preprocessing. Models use at most threads threads.
+        If race_rows is given, models are trained with their default hyperparameters on race_rows of the
+        training rows, and return race_metrics on the validation rows instead of the usual metrics.
+        Models stop training once time.monotonic() passes deadline and are scored as they are then,
+        with BudgetTruncated "True" in their metrics.
+        With checkpoint (save_fp, resume_fp), the trained model is saved to save_fp (see save_model), and
+        if resume_fp isn't None, the model saved there is trained further instead of a new one (see fit_more).
+        """
+        save_fp, resume_fp = checkpoint or (None, None)
+
+        def sklearner(name: str, model_class: Any):
+            def make_model(threads=threads, **config) -> Any:
+                params = Models.model_params(name, dsu.encoding)
+                if name in Models.thread_params:
+                    params[Models.thread_params[name]] = threads
+                return model_class(**dict(params, **config))
+
+            def resume_model() -> Any:
+                mdl = load_model(resume_fp)
+                if name in Models.thread_params:
+                    mdl.set_params(**{Models.thread_params[name]: threads})
+                return mdl
+
+            search_space = None
+            if dsu.search_budget > 0:
+                search_space = Models.search_spaces.get(name)
+            return lambda: Models.sklearner(
+                make_model=make_model,
                 data=data,
+                prep=prep,
+                encoding=Models.encoding(name, dsu.encoding),
+                search_space=search_space,
+                search_budget=dsu.search_budget,
+                threads=threads,
+                race_rows=race_rows,
+                deadline=deadline,
+                resume_model=resume_model if resume_fp is not None else None,
+                save_fp=save_fp,
+            )
+
+        return {
+            "Random Forest Classification": sklearner(
+                "Random Forest Classification", RandomForestClassifier
             ),
-            "XGBoost Regression": lambda: Models.sklearner(
-                dsu=dsu,
-                model=XGBRegressor(
-                    tree_method="hist", eval_metric=mean_absolute_error, random_state=42
-                ),
-                y_is_cat=False,
-                data=data,
+            "Random Forest Regression": sklearner(
+                "Random Forest Regression", RandomForestRegressor
             ),
-            "Gaussian Naive Bayes Classification": lambda: Models.sklearner(
-                dsu=dsu, y_is_cat=True, model=GaussianNB(), data=data
+            "XGBoost Classification": sklearner("XGBoost Classification", XGBClassifier),
+            "XGBoost Regression": sklearner("XGBoost Regression", XGBRegressor),
+            "Gaussian Naive Bayes Classification": sklearner(
+                "Gaussian Naive Bayes Classification", GaussianNB
             ),
             "FastAI Tabular Classification": lambda: Models.fastai_tabular(
-                dsu=dsu, y_is_cat=True, data=data
+                data=data,
+                prep=prep,
+                race_rows=race_rows,
+                deadline=deadline,
+                resume_fp=resume_fp,
+                save_fp=save_fp,
             ),
             "FastAI Tabular Regression": lambda: Models.fastai_tabular(
-                dsu=dsu, y_is_cat=False, data=data
+                data=data,
+                prep=prep,
+                race_rows=race_rows,
+                deadline=deadline,
+                resume_fp=resume_fp,
+                save_fp=save_fp,
             ),
         }
 
     def fastai_tabular(
-        dsu: DataSetup, y_is_cat: bool, data: pd.DataFrame
+        data: pd.DataFrame,
+        prep: Preprocessing,
+        race_rows: int = None,
+        deadline: float = None,
+        resume_fp: str = None,
+        save_fp: str = None,
     ) -> "dict[str, list[str]]":
-        cat_features, cont_features, target_features = dsu.features
-        # data = dsu.load_data()
-        cont_to_fill = cont_features
-        if not y_is_cat:
-            cont_to_fill = cont_to_fill + target_features
-        prep_df(df=data, cont=cont_to_fill)
-
-        training_data, test_data = split_data(data=data)
+        """
+        Trains a tabular learner, or fine-tunes the one saved at resume_fp for FINE_TUNE_EPOCHS epochs with
+        the preprocessing it was trained with, and gets its metrics on the test rows. The learner is saved to save_fp if given
+        """
+        y_is_cat = prep.y_is_cat
+        training_data, test_data = prep.split(data)
+        if race_rows:
+            n_fit = fit_rows(len(training_data))
+            training_data, test_data = (
+                training_data.iloc[:race_rows],
+                training_data.iloc[n_fit:],
+            )
 
-        target_feature = target_features[0]
+        target_feature = prep.target_feature
         y_block = RegressionBlock
         if y_is_cat:
             y_block = CategoryBlock
 
-        dls = TabularPandas(
-            df=training_data,
-            procs=[FillMissing, Categorify, Normalize],
-            cat_names=cat_features,
-            cont_names=cont_features,
-            y_names=target_feature,
-            y_block=y_block,
-            splits=RandomSplitter(valid_pct=0.2)(range_of(training_data)),
-        ).dataloaders(bs=64)
-
-        learn = tabular_learner(dls, metrics=accuracy, default_cbs=True)
-
-        learn.fit_one_cycle(
-            8,
-            cbs=EarlyStoppingCallback(monitor="valid_loss", min_delta=0.01, patience=3),
-        )
+        splits = RandomSplitter(valid_pct=0.2)(range_of(training_data))
+        if resume_fp is None:
+            dls = TabularPandas(
+                df=training_data,
+                procs=[FillMissing, Categorify, Normalize],
+                cat_names=prep.cat_features,
+                cont_names=prep.cont_features,
+                y_names=target_feature,
+                y_block=y_block,
+                splits=splits,
+            ).dataloaders(bs=64)
+            learn = tabular_learner(dls, metrics=accuracy, default_cbs=True)
+            epochs = 8
+        else:
+            learn = load_learner(resume_fp)
+            # The procs fitted on the data the learner was first trained on
+            fitted = learn.dls.train_ds
+            to = TabularPandas(
+                df=training_data,
+                procs=fitted.procs,
+                cat_names=fitted.cat_names,
+                cont_names=fitted.cont_names,
+                y_names=fitted.y_names,
+                y_block=TransformBlock(),
+                splits=splits,
+                do_setup=False,
+                reduce_memory=False,
+            )
+            to.process()
+            learn.dls = to.dataloaders(bs=64)
+            epochs = FINE_TUNE_EPOCHS
+
+        cbs = [EarlyStoppingCallback(monitor="valid_loss", min_delta=0.01, patience=3)]
+        if deadline is not None:
+            cbs.append(DeadlineCallback(deadline))
+        learn.fit_one_cycle(epochs, cbs=cbs)
+        truncated = deadline is not None and cbs[-1].truncated
+        if save_fp is not None:
+            save_model(learn, save_fp)
 
         test_data.drop([target_feature], axis=1)
 
         _, targ, test_pred_decoded = learn.get_preds(
             dl=learn.dls.test_dl(test_data), with_decoded=True
         )
+        if race_rows:
+            return race_metrics(
+                np.asarray(test_pred_decoded).ravel(), np.asarray(targ).ravel(), y_is_cat
+            )
         pred = torch.tensor([[num] for num in test_pred_decoded])
 
         if y_is_cat:
-            return MetricsParser.parse_classification(pred=pred, targ=targ)
+            metrics = MetricsParser.parse_classification(pred=pred, targ=targ)
         else:
-            return MetricsParser.parse_regression(pred=pred, targ=targ)
+            metrics = MetricsParser.parse_regression(pred=pred, targ=targ)
+        return dict(metrics, BudgetTruncated=str(truncated))
 
     def sklearner(
-        dsu: DataSetup, model: Any, y_is_cat: bool, data: pd.DataFrame, do_one_hot=False
+        make_model: "Callable[..., Any]",
+        data: pd.DataFrame,
+        prep: Preprocessing,
+        encoding="codes",
+        search_space: "dict[str, list[Any]]" = None,
+        search_budget=0.0,
+        threads=1,
+        race_rows: int = None,
+        deadline: float = None,
+        resume_model: "Callable[[], Any]" = None,
+        save_fp: str = None,
     ) -> "dict[str, list[str]]":
-        # data: pd.DataFrame = dsu.load_data()
-        cat_features, cont_features, target_features = dsu.features
-        target_feature = target_features[0]
-        for c in data.columns:
-            if c != target_feature and c not in cat_features and c not in cont_features:
-                data.drop([c], axis=1, inplace=True)
-        cont_to_fill = cont_features
-        if not y_is_cat:
-            cont_to_fill += target_features
-        prep_df(df=data, cont=cont_to_fill)
-
-        if do_one_hot:
-            for col in cat_features:
-                s = data[col].unique()
-                # Create a One Hot Dataframe with 1 row for each unique value
-                one_hot_df = pd.get_dummies(s, prefix="%s_" % col)
-                one_hot_df[col] = s
-                pre_len = len(data)
-                # Merge the one hot columns
-                data = data.merge(one_hot_df, on=[col], how="left")
-                data.drop(
-                    [col], axis=1, inplace=True
-                )  # Drop the col, it's no longer needed
-                assert len(data) == pre_len
-
-        training_data, test_data = split_data(data=data)
-
-        x_train = training_data.drop([target_feature], axis=1)
-        x_test = test_data.drop([target_feature], axis=1)
-        y_train = training_data[target_feature]
-        y_test = test_data[target_feature]
-
-        scaler = StandardScaler()
-        x_train = scaler.fit_transform(x_train)
-        x_test = scaler.transform(x_test)
-
-        mdl = model
-        mdl.fit(x_train, y_train)
+        """
+        Trains make_model(**config) until deadline (see fit_within) and gets its metrics on the test rows.
+        config is the best configuration in search_space if given (see Models.search), otherwise empty.
+        If resume_model is given, the model it returns is trained further instead (see fit_more).
+        The trained model is saved to save_fp if given
+        """
+        y_is_cat = prep.y_is_cat
+        x_train, x_test, y_train, y_test = prep.xy(data, encoding=encoding)
+
+        if race_rows:
+            n_fit = fit_rows(len(y_train))
+            mdl = make_model()
+            fit_within(mdl, _rows(x_train, 0, race_rows), y_train[:race_rows], deadline)
+            return race_metrics(
+                mdl.predict(_rows(x_train, n_fit, None)), y_train[n_fit:], y_is_cat
+            )
+
+        if resume_model is not None:
+            mdl = resume_model()
+            truncated = fit_more(mdl, x_train, y_train, deadline)
+            return Models.score(mdl, x_test, y_test, y_is_cat, truncated, save_fp)
+
+        config = {}
+        if search_space:
+            if deadline is not None:
+                search_budget = min(
+                    search_budget,
+                    SEARCH_DEADLINE_SHARE * max(0.0, deadline - time.monotonic()),
+                )
+            config = Models.search(
+                make_model, search_space, x_train, y_train, y_is_cat, search_budget, threads
+            )
+        mdl = make_model(**config)
+        truncated = fit_within(mdl, x_train, y_train, deadline)
+        return Models.score(mdl, x_test, y_test, y_is_cat, truncated, save_fp)
+
+    def score(
+        mdl: Any,
+        x_test: Any,
+        y_test: np.ndarray,
+        y_is_cat: bool,
+        truncated: bool,
+        save_fp: str = None,
+    ) -> "dict[str, list[str]]":
+        """
+        Metrics and hyperparameters of the trained mdl on the test rows. mdl is saved to save_fp if given
+        """
+        if save_fp is not None:
+            save_model(mdl, save_fp)
         xgbpreds = mdl.predict(x_test)
         pred = torch.tensor([[num] for num in xgbpreds])
         targ = torch.tensor([[num] for num in list(y_test)])
 
         hpd: "dict[str, str]" = dict_values_to_str(mdl.get_params())
+        if getattr(mdl, "early_stopping_rounds", None):
+            hpd["BestIteration"] = str(mdl.best_iteration)
 
         metrics: "dict[str, str]" = None
         if y_is_cat:
@@ -238,28 +925,327 @@ class Models:
         else:
             metrics = MetricsParser.parse_regression(pred=pred, targ=targ)
         # print(dict(metrics, **hpd))
-        return dict(metrics, **hpd)
+        return dict(metrics, **hpd, BudgetTruncated=str(truncated))
+
+    def search(
+        make_model: "Callable[..., Any]",
+        space: "dict[str, list[Any]]",
+        x_train: Any,
+        y_train: np.ndarray,
+        y_is_cat: bool,
+        budget: float,
+        threads: int,
+    ) -> "dict[str, Any]":
+        """
+        Searches space for the best hyperparameters by successive halving within budget seconds, with
+        threads single-threaded trials at a time. Trials are trained on the training rows except the
+        last VALIDATION_PERCENTAGE of them and scored on those by accuracy or mean absolute error.
+        :return: the configuration to pass to make_model
+        """
+        n_fit = fit_rows(len(y_train))
+        x_valid, y_valid = _rows(x_train, n_fit, None), y_train[n_fit:]
+
+        def fit_score(config: "dict[str, Any]", rows: int) -> float:
+            mdl = make_model(threads=1, **config)
+            fit_within(mdl, _rows(x_train, 0, rows), y_train[:rows])
+            pred = mdl.predict(x_valid)
+            if y_is_cat:
+                return accuracy_score(y_valid, pred)
+            return -mean_absolute_error(y_valid, pred)
 
+        start = time.monotonic()
+        config, trials = successive_halving(fit_score, space, n_fit, budget, threads)
+        print(
+            f"\tSearched {trials} configurations in {time.monotonic() - start:.1f} s, best {config}"
+        )
+        return config
 
-def prep_df(df: pd.DataFrame, cont: "list[str]"):
+
+def fit_rows(n_train: int) -> int:
+    """
+    Number of training rows models are fitted on when the rest are held out for validation
+    """
+    return n_train - int(n_train * VALIDATION_PERCENTAGE)
+
+
+def fit_within(mdl: Any, x: Any, y: np.ndarray, deadline: float = None) -> bool:
+    """
+    Fits mdl on x, y, stopping once time.monotonic() passes deadline with what has been trained so far:
+    forests grow TREE_INCREMENT or more trees at a time, enough to keep each of their n_jobs busy, and XGBoost stops after the current boosting round.
+    XGBoost models with early_stopping_rounds are fitted on all but the last VALIDATION_PERCENTAGE of
+    the rows and stop early once their loss on those doesn't improve, predicting with their best iteration.
+    Other models are fitted as usual.
+    :return: True if training was cut short by the deadline
     """
-    Fills missing values (median for continuous columns, empty string for other) and ensure that continuous columns as processed as numeric
+    if isinstance(mdl, XGBModel):
+        return _fit_xgboost(mdl, x, y, deadline)
+    if deadline is None:
+        mdl.fit(x, y)
+        return False
+    if isinstance(mdl, (RandomForestClassifier, RandomForestRegressor)):
+        n_estimators, warm_start = mdl.n_estimators, mdl.warm_start
+        # With warm_start, each fit only adds the missing trees, drawn from the same random
+        # state as in a single fit
+        grown = len(getattr(mdl, "estimators_", [])) if warm_start else 0
+        mdl.set_params(warm_start=True, n_estimators=grown)
+        # Each fit only runs the trees it adds in parallel
+        n_jobs = effective_n_jobs(mdl.n_jobs)
+        step = -(-TREE_INCREMENT // n_jobs) * n_jobs
+        while mdl.n_estimators < n_estimators:
+            if mdl.n_estimators > grown and time.monotonic() >= deadline:
+                break
+            mdl.set_params(n_estimators=min(mdl.n_estimators + step, n_estimators))
+            mdl.fit(x, y)
+        mdl.set_params(warm_start=warm_start)
+        return mdl.n_estimators < n_estimators
+    mdl.fit(x, y)
+    return False
+
+
+def fit_more(mdl: Any, x: Any, y: np.ndarray, deadline: float = None) -> bool:
+    """
+    Trains the fitted mdl further on x, y, the rows appended to the export since it was trained, until
+    deadline (see fit_within): forests add INCREMENTAL_TREES trees grown on them, XGBoost adds boosting
+    rounds to its booster and Gaussian Naive Bayes adds them to its class statistics.
+    :return: True if training was cut short by the deadline
     """
+    if isinstance(mdl, (RandomForestClassifier, RandomForestRegressor)):
+        mdl.set_params(warm_start=True, n_estimators=len(mdl.estimators_) + INCREMENTAL_TREES)
+        truncated = fit_within(mdl, x, y, deadline)
+        mdl.set_params(warm_start=False)
+        return truncated
+    if isinstance(mdl, XGBModel):
+        return _fit_xgboost(mdl, x, y, deadline, xgb_model=mdl.get_booster())
+    if isinstance(mdl, GaussianNB):
+        mdl.partial_fit(x, y)
+        return False
+    raise ValueError(f"{type(mdl).__name__} models can't be trained further")
 
-    missing_value_indicators = ["-"]
-    # Remove dashes
-    for f in list(df.columns):
-        for mvi in missing_value_indicators:
-            df[f].replace([mvi], None, inplace=True)
 
-    for f in cont:
-        df[f] = df[f].to_frame().apply(lambda x: x.fillna(str(x.median())), axis=0)
-        df[f] = pd.to_numeric(df[f])
-    # Exception(f"Exception occurred while trying to fill missing values in continuous column <{current}>. Make sure the column does not contain NaN-values.")
-    for f in list(df.columns):
-        if f not in cont:
-            df[f] = df[f].to_frame().apply(lambda x: x.fillna(""), axis=0)
-            df[f] = df[f].astype("category").cat.codes
+def save_model(mdl: Any, fp: str):
+    """
+    Saves a trained model, or a FastAI learner with learn.export, so that it can be trained further later
+    """
+    if isinstance(mdl, Learner):
+        mdl.export(fp)
+        return
+    with open(fp, "wb") as f:
+        pickle.dump(mdl, f)
+
+
+def load_model(fp: str) -> Any:
+    """
+    Loads a model saved by save_model. FastAI learners are loaded with load_learner instead
+    """
+    with open(fp, "rb") as f:
+        return pickle.load(f)
+
+
+def _fit_xgboost(
+    mdl: XGBModel, x: Any, y: np.ndarray, deadline: float = None, xgb_model: Any = None
+) -> bool:
+    # See fit_within, xgb_model is the booster to continue training
+    fit_params = {"xgb_model": xgb_model}
+    if mdl.early_stopping_rounds:
+        n_fit = fit_rows(len(y))
+        fit_params["eval_set"] = [(_rows(x, n_fit, None), y[n_fit:])]
+        x, y = _rows(x, 0, n_fit), y[:n_fit]
+    if deadline is None:
+        mdl.fit(x, y, verbose=False, **fit_params)
+        return False
+    previous_rounds = 0 if xgb_model is None else xgb_model.num_boosted_rounds()
+    callbacks = mdl.callbacks
+    stop = _DeadlineStop(deadline)
+    mdl.set_params(callbacks=list(callbacks or []) + [stop])
+    try:
+        mdl.fit(x, y, verbose=False, **fit_params)
+    finally:
+        mdl.set_params(callbacks=callbacks)
+    rounds = mdl.get_booster().num_boosted_rounds() - previous_rounds
+    return stop.stopped and rounds < mdl.get_num_boosting_rounds()
+
+
+class _DeadlineStop(TrainingCallback):
+    # Stops XGBoost training once time.monotonic() passes deadline
+    def __init__(self, deadline: float):
+        super().__init__()
+        self.deadline = deadline
+        self.stopped = False
+
+    def after_iteration(self, model: Any, epoch: int, evals_log: dict) -> bool:
+        self.stopped = time.monotonic() >= self.deadline
+        return self.stopped
+
+
+class DeadlineCallback(Callback):
+    """
+    Stops FastAI training once time.monotonic() passes deadline, keeping the weights reached so far
+    """
+
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+        self.truncated = False
+
+    def after_batch(self):
+        if time.monotonic() >= self.deadline:
+            self.truncated = True
+            raise CancelFitException()
+
+
+def race_metrics(pred: np.ndarray, targ: np.ndarray, y_is_cat: bool) -> "dict[str, str]":
+    """
+    Mean loss (error rate or absolute error) of pred and its standard error, as reported by model race rungs
+    """
+    if y_is_cat:
+        losses = (pred != targ).astype(np.float64)
+    else:
+        losses = np.abs(pred.astype(np.float64) - targ.astype(np.float64))
+    error = losses.std(ddof=1) / np.sqrt(len(losses)) if len(losses) > 1 else np.inf
+    return {"Loss": str(losses.mean()), "LossError": str(error)}
+
+
+def cv_metrics(fold_metrics: "list[dict[str, str]]") -> "dict[str, str]":
+    """
+    Metrics of a cross-validated model from the metrics of its folds: the mean of each metric, its
+    standard deviation across the folds as <metric>Std and the summed confusion matrix.
+    Hyperparameters are those of the first fold, BudgetTruncated is "True" if any fold was truncated.
+    """
+    metrics = dict(fold_metrics[0])
+    for name in MetricsParser.metric_names():
+        values = [m.get(name, "") for m in fold_metrics]
+        if name == "ConfusionMatrix":
+            if all(values):
+                counts = [dict(c.split(":") for c in v.split(";")) for v in values]
+                metrics[name] = ";".join(
+                    f"{k}:{sum(int(c[k]) for c in counts)}" for k in counts[0]
+                )
+            continue
+        try:
+            numbers = np.array([float(v) for v in values])
+        except ValueError:
+            # Empty for the other kind of target, or an error message
+            continue
+        metrics[name] = str(numbers.mean())
+        metrics[name + "Std"] = str(numbers.std())
+    if "BudgetTruncated" in metrics:
+        metrics["BudgetTruncated"] = str(
+            any(m.get("BudgetTruncated") == "True" for m in fold_metrics)
+        )
+    metrics["Folds"] = str(len(fold_metrics))
+    return metrics
+
+
+def _rows(x: Any, start: int, stop: int) -> Any:
+    # Rows start:stop of an array, sparse matrix or DataFrame
+    if isinstance(x, pd.DataFrame):
+        return x.iloc[start:stop]
+    return x[start:stop]
+
+
+def prep_df(
+    df: pd.DataFrame,
+    cont: "list[str]",
+    medians: "dict[str, float]" = None,
+    categories: "dict[str, pd.Index]" = None,
+    unseen_as_missing: "list[str]" = (),
+) -> pd.DataFrame:
+    """
+    Fills missing values (median for continuous columns, empty string for other) and ensure that continuous columns as processed as numeric.
+    Other columns are replaced by their category codes.
+    medians and categories (see prep_params) are used instead of those of df if given, values that aren't
+    in categories raise ValueError, except in the columns of unseen_as_missing where they're coded as "".
+    Returns a new DataFrame, df (which may be read-only shared memory) isn't modified
+    """
+    cont = [c for c in df.columns if c in cont]
+    columns: "dict[str, Any]" = {}
+    if cont:
+        numeric = pd.DataFrame(
+            {c: pd.to_numeric(_drop_missing_values(df[c])) for c in cont}, index=df.index
+        )
+        fill = numeric.median() if medians is None else pd.Series(medians)
+        columns.update(numeric.fillna(fill).items())
+    for c in df.columns:
+        if c not in cont:
+            columns[c] = _category_codes(
+                df[c], None if categories is None else categories[c], c in unseen_as_missing
+            )
+    df = pd.DataFrame({c: columns[c] for c in df.columns}, index=df.index)
 
     if df.isnull().values.any():
         raise Exception(f"Filling missing values failed")
+    return df
+
+
+def _drop_missing_values(col: pd.Series) -> pd.Series:
+    """
+    col with MISSING_VALUES replaced by NaN. Only text can contain them
+    """
+    if col.dtype == object:
+        return col.mask(col.isin(MISSING_VALUES))
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        return col.astype(object).mask(col.isin(MISSING_VALUES))
+    return col
+
+
+def prep_params(
+    df: pd.DataFrame, cont: "list[str]"
+) -> "tuple[dict[str, float], dict[str, pd.Index]]":
+    """
+    Medians of the continuous columns of df and categories of the other columns, which prep_df
+    fills missing values with and codes categories by
+    """
+    medians = {
+        c: pd.to_numeric(_drop_missing_values(df[c])).median() for c in df.columns if c in cont
+    }
+    categories = {
+        c: _categories(*_category_labels(df[c])) for c in df.columns if c not in cont
+    }
+    return medians, categories
+
+
+def _category_codes(
+    col: pd.Series, categories: pd.Index = None, unseen_as_missing=False
+) -> pd.Series:
+    """
+    Codes of col as categories, sorted as by col.astype("category"), with missing values
+    and MISSING_VALUES counted as the category "". Works on the distinct values only, rows are
+    only touched when coding col and translating the codes.
+    If categories is given, values are coded by their position in it, and values that aren't in it raise ValueError,
+    or are coded as "" with unseen_as_missing if categories has it
+    """
+    codes, labels = _category_labels(col)
+    if categories is None:
+        categories = _categories(codes, labels)
+    # Old code -> new code
+    mapping = categories.get_indexer(labels)
+    new_codes = mapping[codes]
+    if unseen_as_missing and "" in categories:
+        new_codes[new_codes < 0] = categories.get_loc("")
+    if (new_codes < 0).any():
+        raise ValueError(f"Column <{col.name}> has categories that weren't seen before")
+    new_codes = new_codes.astype(_codes_dtype(len(categories)))
+    return pd.Series(new_codes, index=col.index, name=col.name)
+
+
+def _category_labels(col: pd.Series) -> "tuple[np.ndarray, pd.Series]":
+    # Codes of col as a categorical and the label of each code, with missing values (code -1) moved to the end
+    values = col.astype("category")
+    labels = pd.Series(list(values.cat.categories) + [""], dtype=object)
+    labels = labels.mask(labels.isin(MISSING_VALUES), "")
+    codes = values.cat.codes.to_numpy()
+    codes = np.where(codes < 0, len(labels) - 1, codes)
+    return codes, labels
+
+
+def _categories(codes: np.ndarray, labels: pd.Series) -> pd.Index:
+    # Sorted distinct labels of the codes that occur
+    used = np.bincount(codes, minlength=len(labels)) > 0
+    return pd.Categorical(labels[used].unique()).categories
+
+
+def _codes_dtype(n_categories: int) -> np.dtype:
+    # Smallest integer type that holds the codes, as used by pandas
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_categories < np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
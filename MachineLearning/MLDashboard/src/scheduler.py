@@ -0,0 +1,76 @@
+from collections import deque
+from typing import Any
+
+# Priority classes in the order they are served. A class is only served when all classes before it are empty
+PRIORITY_CLASSES = ("interactive", "batch")
+
+
+class FairScheduler:
+    """
+    Pending training tasks queued per document (task.group, the document's cwd).
+    Documents within a priority class share the workers by weighted fair queuing: each has a virtual
+    pass that grows by 1 / task.weight for every task it gets, and the document with the lowest pass goes next.
+    A document joining the queue starts at the class's current virtual time, so a document that has
+    queued a long sweep can't starve one that arrives later with a single model.
+    """
+
+    def __init__(self):
+        # group -> queue of its pending tasks, only non-empty queues are kept
+        self._queues: "dict[str, deque]" = {}
+        # group -> virtual pass of the group's next task
+        self._pass: "dict[str, float]" = {}
+        # priority class -> virtual time (pass of the last task served)
+        self._vtime: "dict[str, float]" = {c: 0.0 for c in PRIORITY_CLASSES}
+        self._priority: "dict[str, str]" = {}
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def push(self, task: Any):
+        priority = task.priority
+        if priority not in PRIORITY_CLASSES:
+            priority = PRIORITY_CLASSES[0]
+        if task.group not in self._queues:
+            self._queues[task.group] = deque()
+            self._pass[task.group] = self._vtime[priority]
+            self._priority[task.group] = priority
+        self._queues[task.group].append(task)
+        self._len += 1
+
+    def pop(self) -> Any:
+        """
+        :return: the next task to run, None if there are none
+        """
+        for priority in PRIORITY_CLASSES:
+            groups = [g for g, p in self._priority.items() if p == priority]
+            if not groups:
+                continue
+            group = min(groups, key=lambda g: self._pass[g])
+            task = self._queues[group].popleft()
+            self._vtime[priority] = self._pass[group]
+            self._pass[group] += 1 / max(task.weight, 1e-9)
+            self._len -= 1
+            if not self._queues[group]:
+                self._drop_group(group)
+            return task
+        return None
+
+    def remove(self, task: Any) -> bool:
+        """
+        Removes task if it is still pending.
+        :return: True if the task was removed
+        """
+        queue = self._queues.get(task.group)
+        if queue is None or task not in queue:
+            return False
+        queue.remove(task)
+        self._len -= 1
+        if not queue:
+            self._drop_group(task.group)
+        return True
+
+    def _drop_group(self, group: str):
+        del self._queues[group]
+        del self._pass[group]
+        del self._priority[group]
@@ -0,0 +1,70 @@
+import itertools
+import math
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+_ETA = 3  # Share of the trials kept after each rung is 1 / _ETA, and their rows grow _ETA-fold
+_MIN_ROWS = 100  # Rows the trials of the first rung are trained on at least
+
+
+def grid(space: "dict[str, list[Any]]") -> "list[dict[str, Any]]":
+    """
+    All combinations of the values in space
+    """
+    names = sorted(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[n] for n in names))]
+
+
+def successive_halving(
+    fit_score: "Callable[[dict[str, Any], int], float]",
+    space: "dict[str, list[Any]]",
+    rows: int,
+    budget: float,
+    parallel: int,
+    eta=_ETA,
+    min_rows=_MIN_ROWS,
+    seed=42,
+) -> "tuple[dict[str, Any], int]":
+    """
+    Searches space for the configuration with the highest fit_score(config, rows), rows being the number
+    of training rows the trial may use, at most rows.
+    Configurations sampled from the grid are first tried on few rows, the best 1 / eta of them are tried
+    again on eta times the rows, and so on until the last rung uses all rows. parallel trials run at once,
+    and no trials are started once budget seconds have passed; the search then returns what it has.
+    :return: the best configuration ({} if no trial finished) and the number of trials run
+    """
+    deadline = time.monotonic() + budget
+    rungs = 1 + max(0, int(math.log(max(rows, 1) / min_rows, eta)))
+    configs = grid(space)
+    random.Random(seed).shuffle(configs)
+    configs = configs[: eta ** (rungs - 1)]
+
+    best: "dict[str, Any]" = {}
+    trials = 0
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        for rung in range(rungs):
+            rung_rows = max(1, rows // eta ** (rungs - 1 - rung))
+
+            def trial(config: "dict[str, Any]") -> float:
+                if time.monotonic() >= deadline:
+                    return None
+                try:
+                    return fit_score(config, rung_rows)
+                except Exception as e:
+                    print(f"\tTrial {config} failed: {e}")
+                    return -math.inf
+
+            scores = list(executor.map(trial, configs))
+            finished = [(s, c) for s, c in zip(scores, configs) if s is not None]
+            trials += len(finished)
+            if not finished:
+                break
+            finished.sort(key=lambda sc: sc[0], reverse=True)
+            best = finished[0][1]
+            if len(finished) < len(configs):
+                # Out of time
+                break
+            configs = [c for _, c in finished[: max(1, len(finished) // eta)]]
+    return best, trials
@@ -0,0 +1,123 @@
+import gc
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any
+import pandas as pd
+import numpy as np
+
+_ALIGNMENT = 8  # Byte alignment of each column within the shared block
+
+
+class SharedFrameSpec:
+    """
+    Picklable description of a SharedFrame, sent to worker processes instead of the data itself
+    """
+
+    def __init__(
+        self,
+        shm_name: str,
+        rows: int,
+        columns: "list[tuple[str, str, int, np.ndarray, bool]]",
+        index: np.ndarray,
+        meta: Any,
+    ):
+        self.shm_name = shm_name
+        self.rows = rows
+        # (column name, numpy dtype string, byte offset, categories or None, is pandas categorical)
+        self.columns = columns
+        self.index = index
+        # Picklable object describing the data, passed along as is
+        self.meta = meta
+
+
+class SharedFrame:
+    """
+    Stores a DataFrame once in shared memory so that worker processes can attach to it without copying.
+    Numeric columns are stored as is and attached as read-only views. Categorical columns are attached
+    as categoricals whose codes are read-only views. Other columns are stored as integer codes and
+    rebuilt from their (usually short) list of categories when attached.
+    The index and meta are sent to workers as part of the spec.
+    """
+
+    def __init__(self, df: pd.DataFrame, meta: Any = None):
+        columns: "list[tuple[str, np.ndarray, np.ndarray, bool]]" = []
+        for name in df.columns:
+            col = df[name]
+            is_categorical = isinstance(col.dtype, pd.CategoricalDtype)
+            categories = None
+            if is_categorical:
+                values = col.cat.codes.to_numpy()
+                categories = np.asarray(col.cat.categories)
+            else:
+                values = col.to_numpy()
+            if not is_categorical and values.dtype.kind not in "biuf":
+                codes, uniques = pd.factorize(df[name])
+                # Missing values (code -1) point at a trailing NaN category
+                categories = np.append(np.asarray(uniques, dtype=object), np.nan)
+                values = np.where(codes < 0, len(uniques), codes).astype(np.int32)
+            columns.append(
+                (name, np.ascontiguousarray(values), categories, is_categorical)
+            )
+
+        offset = 0
+        layout: "list[tuple[str, str, int, np.ndarray, bool]]" = []
+        for name, values, categories, is_categorical in columns:
+            layout.append((name, values.dtype.str, offset, categories, is_categorical))
+            offset += -(-values.nbytes // _ALIGNMENT) * _ALIGNMENT
+        # Zero-sized blocks are not allowed
+        self.shm = SharedMemory(create=True, size=max(offset, 1))
+        for (_, values, _, _), (_, dtype, offset, _, _) in zip(columns, layout):
+            np.ndarray(values.shape, dtype=dtype, buffer=self.shm.buf, offset=offset)[
+                :
+            ] = values
+        self.spec = SharedFrameSpec(
+            self.shm.name, df.shape[0], layout, df.index.to_numpy(), meta
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return self.shm.size
+
+    def close(self):
+        """
+        Releases the shared memory block. Attached frames must no longer be used after this.
+        """
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def attach(spec: SharedFrameSpec) -> "tuple[pd.DataFrame, SharedMemory]":
+        """
+        Attaches to the shared block described by spec. The returned SharedMemory must be kept
+        referenced for as long as the DataFrame is in use.
+        """
+        shm = SharedMemory(name=spec.shm_name)
+        data: "dict[str, Any]" = {}
+        for name, dtype, offset, categories, is_categorical in spec.columns:
+            values = np.ndarray((spec.rows,), dtype=dtype, buffer=shm.buf, offset=offset)
+            values.flags.writeable = False
+            if is_categorical:
+                values = pd.Categorical.from_codes(values, categories=categories)
+            elif categories is not None:
+                values = categories.take(values)
+            data[name] = values
+        # copy=False keeps the numeric columns as views into the shared block
+        return pd.DataFrame(data, index=spec.index, copy=False), shm
+
+    @staticmethod
+    def detach(shm: SharedMemory):
+        """
+        Unmaps a block returned by attach once nothing refers to the attached DataFrame anymore.
+        Long-lived worker processes call this after every job.
+        """
+        gc.collect()
+        try:
+            shm.close()
+        except BufferError:
+            # Some view is still alive, the mapping is released when it is garbage collected
+            pass
@@ -0,0 +1,416 @@
+import os
+import queue
+import threading
+import time
+import traceback
+from multiprocessing import Pipe, Process, resource_tracker
+from multiprocessing.connection import Connection, wait
+import pandas as pd
+from threadpoolctl import threadpool_limits
+from models import *
+from sharedframe import SharedFrame, SharedFrameSpec
+from scheduler import FairScheduler
+
+_IDLE_WAIT = 1.0  # Seconds the dispatcher sleeps when no training is running
+_RETIRE_WAIT = 5.0  # Seconds a retired worker is given to exit before it's terminated
+_ERROR_WAIT = 1.0  # Seconds the dispatcher waits after an unexpected error before going on
+# Share of the timeout models train for before they stop and are scored with what they have,
+# the rest is left for scoring them. The worker is only killed once the whole timeout has passed
+_TRAINING_SHARE = 0.8
+
+
+def train_and_get_metrics(
+    dsu: DataSetup,
+    spec: SharedFrameSpec,
+    model_name: str,
+    threads: int = 1,
+    race_rows: int = None,
+    budget: float = None,
+    fold: "tuple[int, int]" = None,
+    checkpoint: "tuple[str, str]" = None,
+) -> "tuple[str, Any]":
+    '''
+    Plugin main functionality. Trains model_name on the shared data described by spec, prepared
+    by the Preprocessing in spec.meta, using at most threads threads, and returns ("ok", metrics) or ("error", message).
+    With race_rows, the metrics are those of a model race rung, see Models.getters.
+    With budget, training stops after budget seconds and the model is scored as it is then.
+    With fold (fold, folds), the model is trained and scored on that cross-validation fold, see Preprocessing.fold.
+    With checkpoint (save_fp, resume_fp), the model is saved and possibly trained further, see Models.getters,
+    and Resumed in its metrics tells whether it was trained further
+    '''
+    print(f"Training with <{model_name}> on {threads} threads")
+    deadline = None
+    if budget is not None:
+        deadline = time.monotonic() + budget
+    data, shm = SharedFrame.attach(spec)
+    method = None
+    try:
+        prep: Preprocessing = spec.meta
+        if fold is not None:
+            prep = prep.fold(*fold)
+        method = Models.getters(
+            dsu=dsu,
+            data=data,
+            prep=prep,
+            threads=threads,
+            race_rows=race_rows,
+            deadline=deadline,
+            checkpoint=checkpoint,
+        )[model_name]
+        # Also limits the BLAS and OpenMP pools the libraries use internally
+        torch.set_num_threads(threads)
+        with threadpool_limits(limits=threads):
+            metrics: "dict[str, str]" = method() # Trains and gets metrics
+        if checkpoint is not None:
+            metrics["Resumed"] = str(checkpoint[1] is not None)
+        print(f"\tSuccess, sent metrics")
+        return "ok", metrics
+    except Exception as e:
+        print(traceback.format_exc())
+        return "error", f"{type(e).__name__} was raised: {e}"
+    finally:
+        del data, method
+        SharedFrame.detach(shm)
+
+
+def _worker_main(conn: Connection):
+    """
+    Worker process loop. The ML libraries are imported once when this module is loaded,
+    after which the worker trains one model per received task until it gets None.
+    """
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        conn.send(train_and_get_metrics(*task))
+    conn.close()
+
+
+class TrainingTask:
+    """
+    A single model to be trained by a TrainingPool. The result (model_name, metrics, error) is put
+    into results once the model has been trained, has failed or has timed out.
+    """
+
+    def __init__(
+        self,
+        dsu: DataSetup,
+        spec: SharedFrameSpec,
+        model_name: str,
+        results: queue.Queue,
+        race_rows: int = None,
+        fold: "tuple[int, int]" = None,
+        checkpoint: "tuple[str, str]" = None,
+    ):
+        self.dsu = dsu
+        self.spec = spec
+        self.model_name = model_name
+        self.results = results
+        self.race_rows = race_rows
+        self.fold = fold
+        self.checkpoint = checkpoint
+        # Scheduling: the document the task belongs to, its share of the workers and priority class
+        self.group: str = dsu.cwd
+        self.weight: float = dsu.weight
+        self.priority: str = dsu.priority
+        # Threads the task may use, set when it's started
+        self.threads = 1
+        self.deadline: float = None
+        self.cancelled = False
+        self.done = False
+
+    def finish(self, metrics: "dict[str, str]" = None, error: Exception = None):
+        self.done = True
+        self.results.put((self.model_name, metrics, error))
+
+
+class _Worker:
+    """
+    Parent side handle of a worker process
+    """
+
+    def __init__(self):
+        self.conn, child_conn = Pipe()
+        self.process = Process(
+            target=_worker_main, name="training_worker", args=(child_conn,)
+        )
+        self.process.start()
+        child_conn.close()  # Only the child uses its end
+        self.jobs = 0
+        self.task: TrainingTask = None
+
+    def run(self, task: TrainingTask, timeout: float):
+        task.deadline = time.monotonic() + timeout
+        self.task = task
+        self.conn.send(
+            (
+                task.dsu,
+                task.spec,
+                task.model_name,
+                task.threads,
+                task.race_rows,
+                timeout * _TRAINING_SHARE,
+                task.fold,
+                task.checkpoint,
+            )
+        )
+
+    def retire(self):
+        """
+        Asks an idle worker to exit, terminating it if it doesn't
+        """
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(_RETIRE_WAIT)
+        self.kill()
+
+    def kill(self):
+        if self.process.exitcode is None:
+            self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+
+class TrainingPool:
+    """
+    Long-lived pool of training processes started once at server start-up, so that requests don't
+    pay for starting an interpreter and importing fastai, torch, xgboost and sklearn.
+    A dispatcher thread hands queued tasks to idle workers, fairly across documents (see FairScheduler),
+    and enforces the per-model timeout. Models are asked to stop training before the timeout and return
+    what they have (see _TRAINING_SHARE), workers still busy when it has passed are killed.
+    Workers that time out or crash are replaced, and each worker is replaced after
+    max_jobs_per_worker jobs to contain memory leaks in the ML libraries.
+    The cpus cores are shared between the running tasks: each task is given a share of the threads that are
+    free when it starts, at most cpus // processes so that tasks arriving later find cores for them too
+    (see _threads), and tasks stay queued while every core is in use, so that running tasks together never
+    ask for more threads than there are cores.
+    """
+
+    def __init__(
+        self, processes: int, timeout: float, max_jobs_per_worker: int, cpus: int = None
+    ):
+        self.processes = max(1, processes)
+        self.cpus = max(1, cpus or os.cpu_count() or 1)
+        self.max_threads = max(1, self.cpus // self.processes)  # Per task, so that every worker can run
+        self.timeout = timeout
+        self.max_jobs_per_worker = max(1, max_jobs_per_worker)
+        self._workers: "list[_Worker]" = []
+        self._pending = FairScheduler()
+        self._lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = Pipe(duplex=False)
+        self._dispatcher: threading.Thread = None
+        self._stopping = False
+
+    def start(self):
+        if os.name == "posix":
+            # Workers must share the parent's resource tracker. One started lazily by a worker
+            # would unlink the shared data blocks it has seen when that worker is replaced.
+            resource_tracker.ensure_running()
+        self._workers = [_Worker() for _ in range(self.processes)]
+        self._dispatcher = threading.Thread(
+            target=self._dispatch, name="training_dispatcher", daemon=True
+        )
+        self._dispatcher.start()
+
+    def stop(self):
+        with self._lock:
+            self._stopping = True
+            self._wake()
+        if self._dispatcher is not None:
+            self._dispatcher.join()
+        for worker in self._workers:
+            if worker.task is not None:
+                worker.task.finish(error=RuntimeError("Training pool stopped"))
+                worker.kill()
+            else:
+                worker.retire()
+        while self._pending:
+            self._pending.pop().finish(error=RuntimeError("Training pool stopped"))
+
+    def submit(self, tasks: "list[TrainingTask]"):
+        with self._lock:
+            for task in tasks:
+                self._pending.push(task)
+            self._wake()
+
+    def cancel(self, tasks: "list[TrainingTask]"):
+        """
+        Drops tasks that haven't been started and stops the ones being trained
+        """
+        with self._lock:
+            for task in tasks:
+                if not task.done:
+                    task.cancelled = True
+                    self._pending.remove(task)
+            self._wake()
+
+    def train(
+        self,
+        dsu: DataSetup,
+        specs: "dict[str, SharedFrameSpec]",
+        race_rows: int = None,
+        folds: int = 0,
+        checkpoints: "dict[str, tuple[str, str]]" = None,
+    ):
+        """
+        Trains each model name in specs in the pool on the prepared data of the SharedFrame described by
+        its spec, see Models.preprocessing. Every worker attaches to the shared data instead of receiving a copy.
+        With race_rows, runs a model race rung instead (see Models.getters).
+        With folds of at least 2, each of a model's cross-validation folds is trained as a task of its own, so
+        that the folds run in parallel, see Preprocessing.fold.
+        Models in checkpoints are saved and possibly trained further, see Models.getters.
+        Yields (model_name, metrics, error) in order of completion, error being None if training succeeded,
+        once per model or once per fold of each model.
+        """
+        checkpoints = checkpoints or {}
+        results: queue.Queue = queue.Queue()
+        tasks = [
+            TrainingTask(
+                dsu,
+                spec,
+                model_name,
+                results,
+                race_rows,
+                (fold, folds) if folds > 1 else None,
+                checkpoints.get(model_name),
+            )
+            for model_name, spec in specs.items()
+            for fold in range(max(1, folds))
+        ]
+        self.submit(tasks)
+        try:
+            for _ in tasks:
+                yield results.get()
+        finally:
+            # Only has an effect if the caller stopped iterating early
+            self.cancel(tasks)
+
+    def _wake(self):
+        # Called with self._lock held
+        self._wakeup_w.send_bytes(b"")
+
+    def _dispatch(self):
+        while True:
+            try:
+                if not self._dispatch_step():
+                    return
+            except Exception:
+                # The dispatcher must keep going, or every task waiting for a result would wait forever.
+                # A worker that couldn't be replaced is replaced on the next step.
+                print(traceback.format_exc())
+                time.sleep(_ERROR_WAIT)
+
+    def _dispatch_step(self) -> bool:
+        """
+        Starts pending tasks on idle workers, waits for a result, a crash, a deadline or a wake-up and handles it.
+        :return: False once the pool is stopping
+        """
+        with self._lock:
+            if self._stopping:
+                return False
+            # Workers that died and couldn't be replaced yet are left out
+            idle = [w for w in self._workers if w.task is None and w.process.exitcode is None]
+            # Tasks wait for a running one to finish while every core is in use
+            starting = min(len(idle), len(self._pending), self._free_cpus())
+            for worker in idle[:starting]:
+                task = self._pending.pop()
+                task.threads = self._threads(starting)
+                starting -= 1
+                try:
+                    worker.run(task, self.timeout)
+                except OSError as e:
+                    # Died since the last wait: fails like a crash, and the worker is replaced below
+                    worker.task = None
+                    task.finish(error=RuntimeError(f"Training process can't be reached: {e}"))
+                    worker.kill()
+        busy = [w for w in self._workers if w.task is not None]
+        now = time.monotonic()
+        next_deadline = min((w.task.deadline for w in busy), default=now + _IDLE_WAIT)
+        ready = wait(
+            [self._wakeup_r]
+            + [w.conn for w in busy]
+            + [w.process.sentinel for w in self._workers],
+            timeout=max(0.0, next_deadline - now),
+        )
+        while self._wakeup_r.poll():
+            self._wakeup_r.recv_bytes()
+
+        for i, worker in enumerate(self._workers):
+            if self._check_worker(worker, ready):
+                self._workers[i] = _Worker()
+        return True
+
+    def _threads(self, starting: int) -> int:
+        """
+        Threads for a task that is started together with starting - 1 others: an equal share of the
+        cores not used by the running tasks, at least one as no more tasks than free cores are started,
+        and at most max_threads
+        """
+        return min(self.max_threads, max(1, self._free_cpus() // max(1, starting)))
+
+    def _free_cpus(self) -> int:
+        # Cores not used by the running tasks
+        return max(0, self.cpus - sum(w.task.threads for w in self._workers if w.task is not None))
+
+    def _check_worker(self, worker: _Worker, ready: list) -> bool:
+        """
+        Handles a finished, crashed, cancelled or timed out task of worker.
+        :return: True if the worker was shut down and must be replaced
+        """
+        task = worker.task
+        if task is not None and worker.conn in ready:
+            try:
+                status, payload = worker.conn.recv()
+            except (EOFError, OSError):
+                worker.process.join()
+                task.finish(
+                    error=RuntimeError(
+                        f"Training process exited with code {worker.process.exitcode}"
+                    )
+                )
+                worker.kill()
+                return True
+            worker.task = None
+            worker.jobs += 1
+            if task.cancelled:
+                pass
+            elif status == "ok":
+                task.finish(metrics=payload)
+            else:
+                task.finish(error=RuntimeError(payload))
+            if worker.jobs >= self.max_jobs_per_worker:
+                worker.retire()
+                return True
+        elif worker.process.sentinel in ready:
+            # Died while idle or without sending a result
+            worker.process.join()
+            if task is not None:
+                task.finish(
+                    error=RuntimeError(
+                        f"Training process exited with code {worker.process.exitcode}"
+                    )
+                )
+            worker.kill()
+            return True
+        elif task is not None and task.cancelled:
+            worker.kill()
+            return True
+        elif task is not None and time.monotonic() >= task.deadline:
+            task.finish(
+                error=TimeoutError(f"Training took more than {self.timeout} seconds")
+            )
+            worker.kill()
+            return True
+        return False
+
+
+def default_max_parallel() -> int:
+    """
+    Number of models trained at the same time unless configured otherwise
+    """
+    return os.cpu_count() or 1